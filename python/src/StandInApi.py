@@ -0,0 +1,284 @@
+import csv
+import json
+import re
+from collections import defaultdict, Counter
+from datetime import datetime
+from io import BytesIO, StringIO
+from threading import Lock
+from typing import Dict, List, Set, Iterable
+from urllib.parse import urlsplit, parse_qs
+
+from pywikiapi.utils import to_timestamp
+from requests import Response, PreparedRequest
+from requests.adapters import BaseAdapter
+
+from dibabel.DataTypes import Domain, Title, RevComment, RevID, QID, WdSitelink
+from dibabel.SitelinkSource import WdItem, multi_site_class, non_multi_site_class
+from dibabel.utils import calc_hash, title_to_url, primary_domain, wikidata_domain
+
+# Namespace ID -> canonical name, which every wiki accepts besides its local name
+_canonical_namespaces = {10: 'Template', 828: 'Module'}
+_entity_prefix = 'http://www.wikidata.org/entity/'
+
+
+class StandInApi(BaseAdapter):
+    """
+    Answers the MediaWiki API requests of any number of wikis without the network, to test and benchmark
+    the refresh logic. Mount it on the session in place of the real API, e.g. session.mount('https://', api).
+    Pages are edited, moved, and deleted by calling its methods, and the changes are replayed by the API,
+    including the recentchanges feed. Only the requests made by WikiSite are supported, without continuation.
+    Wikidata items are answered both by the Wikidata API and by the query service, for the requests and
+    the queries made by the sitelink sources.
+    The local names of the Template and Module namespaces of each wiki are given as domain -> namespace ID -> name,
+    the wikis that are not listed use the canonical names.
+    """
+
+    def __init__(self, namespaces: Dict[Domain, Dict[int, str]] = None):
+        super().__init__()
+        self.namespaces = namespaces or {}
+        self.pages: Dict[Domain, Dict[Title, List[RevComment]]] = defaultdict(dict)
+        self.changes: Dict[Domain, List[dict]] = defaultdict(list)
+        self.items: Dict[QID, WdItem] = {}
+        self._item_revids: Dict[QID, RevID] = {}
+        # Number of requests and of response bytes per wiki
+        self.requests = Counter()
+        self.response_bytes = Counter()
+        self._last_revid = 0
+        self._lock = Lock()
+
+    def edit(self, domain: Domain, title: Title, content: str,
+             user='StandIn', comment='', ts: datetime = None) -> RevID:
+        with self._lock:
+            self._last_revid += 1
+            ts = to_timestamp(ts or datetime.utcnow())
+            history = self.pages[domain].setdefault(title, [])
+            self._add_change(domain, title, ts, 'edit' if history else 'new', comment=comment)
+            history.append(RevComment(user, ts, comment, content, self._last_revid))
+            return self._last_revid
+
+    def move(self, domain: Domain, title: Title, new_title: Title, ts: datetime = None) -> None:
+        # Moves do not leave a redirect behind
+        with self._lock:
+            self.pages[domain][new_title] = self.pages[domain].pop(title)
+            self._add_change(domain, title, to_timestamp(ts or datetime.utcnow()), 'log',
+                             logtype='move', logaction='move', logparams=dict(target_title=new_title), comment='')
+
+    def delete(self, domain: Domain, title: Title, ts: datetime = None) -> None:
+        with self._lock:
+            del self.pages[domain][title]
+            self._add_change(domain, title, to_timestamp(ts or datetime.utcnow()), 'log',
+                             logtype='delete', logaction='delete', logparams={}, comment='')
+
+    def set_item(self, qid: QID, classes: Iterable[QID], sitelinks: Dict[Domain, Title],
+                 ts: datetime = None, comment: str = None) -> None:
+        # Like Wikibase, the default summary mentions the classes that were added or removed
+        classes = set(classes)
+        if comment is None:
+            changed = classes.symmetric_difference(self.items[qid].classes if qid in self.items else set())
+            comment = ' '.join(f'/* wbsetclaim */ [[Property:P31]]: [[{v}]]' for v in sorted(changed)) \
+                      or '/* wbsetsitelink-set */'
+        with self._lock:
+            self._last_revid += 1
+            self._add_change(wikidata_domain, qid, to_timestamp(ts or datetime.utcnow()),
+                             'edit' if qid in self.items else 'new', comment=comment)
+            self.items[qid] = WdItem(qid, classes, [WdSitelink(qid, d, t) for d, t in sitelinks.items()])
+            self._item_revids[qid] = self._last_revid
+
+    def delete_item(self, qid: QID, ts: datetime = None) -> None:
+        with self._lock:
+            del self.items[qid]
+            del self._item_revids[qid]
+            self._add_change(wikidata_domain, qid, to_timestamp(ts or datetime.utcnow()), 'log',
+                             logtype='delete', logaction='delete', logparams={}, comment='')
+
+    def reset_counters(self) -> None:
+        self.requests.clear()
+        self.response_bytes.clear()
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        url = urlsplit(request.url)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if request.body:
+            body = request.body.decode() if isinstance(request.body, bytes) else request.body
+            params.update({k: v[0] for k, v in parse_qs(body).items()})
+        domain = url.hostname
+        with self._lock:
+            if url.path.endswith('/sparql'):
+                data = self._sparql(params['query']).encode()
+                content_type = 'text/csv; charset=utf-8'
+            else:
+                if params.get('action') == 'wbgetentities':
+                    result = dict(entities=self._entities(params))
+                elif params.get('action') == 'query':
+                    result = dict(batchcomplete=True, query=self._query(domain, params))
+                else:
+                    raise ValueError(f"Unsupported action {params.get('action')}")
+                data = json.dumps(result).encode()
+                content_type = 'application/json; charset=utf-8'
+            self.requests[domain] += 1
+            self.response_bytes[domain] += len(data)
+
+        response = Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = content_type
+        response.raw = BytesIO(data)
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+    def _query(self, domain: Domain, params: Dict[str, str]) -> dict:
+        result = {}
+        if params.get('meta') == 'siteinfo':
+            result.update(self._siteinfo(domain))
+        if params.get('list') == 'recentchanges':
+            result['recentchanges'] = self._recent_changes(domain, params)
+        if params.get('list') == 'search':
+            result['search'] = self._search(params['srsearch'])
+        if 'titles' in params:
+            result['pages'] = [self._page(domain, title, params) for title in params['titles'].split('|')]
+        if 'revids' in params:
+            result['pages'] = self._revisions(domain, {int(v) for v in params['revids'].split('|')}, params)
+        return result
+
+    def _siteinfo(self, domain: Domain) -> dict:
+        local = self.namespaces.get(domain, {})
+        return dict(
+            magicwords=[], extensions=[], namespacealiases=[],
+            namespaces={str(ns): dict(id=ns, name=local.get(ns, canonical), canonical=canonical)
+                        for ns, canonical in _canonical_namespaces.items()})
+
+    def _namespace(self, domain: Domain, title: Title) -> int:
+        prefix = title.split(':', 1)[0] if ':' in title else ''
+        local = self.namespaces.get(domain, {})
+        for ns, canonical in _canonical_namespaces.items():
+            if prefix in (canonical, local.get(ns)):
+                return ns
+        return 0
+
+    def _search(self, search: str) -> List[dict]:
+        m = re.match(r'^haswbstatement:P31=(Q\d+)$', search)
+        if not m:
+            raise ValueError(f'Unsupported search {search}')
+        return [dict(ns=0, title=qid) for qid, item in self.items.items() if m.group(1) in item.classes]
+
+    def _entities(self, params: Dict[str, str]) -> Dict[str, dict]:
+        entities = {}
+        if 'ids' in params:
+            for qid in params['ids'].split('|'):
+                entities[qid] = self._entity(qid) if qid in self.items else dict(id=qid, missing=True)
+        else:
+            domain = next(d for d in self._all_domains() if _site_id(d) == params['sites'])
+            by_title = {sl.title: qid
+                        for qid, item in self.items.items() for sl in item.sitelinks if sl.domain == domain}
+            for idx, title in enumerate(params['titles'].split('|')):
+                qid = by_title.get(title)
+                if qid:
+                    entities[qid] = self._entity(qid)
+                else:
+                    entities[str(-1 - idx)] = dict(site=params['sites'], title=title, missing=True)
+        return entities
+
+    def _entity(self, qid: QID) -> dict:
+        item = self.items[qid]
+        return dict(
+            type='item', id=qid, lastrevid=self._item_revids[qid],
+            claims=dict(P31=[dict(rank='normal', mainsnak=dict(
+                snaktype='value', property='P31', datavalue=dict(type='wikibase-entityid', value=dict(id=cls))))
+                             for cls in sorted(item.classes)]),
+            sitelinks={_site_id(sl.domain): dict(site=_site_id(sl.domain), title=sl.title,
+                                                 url=title_to_url(sl.domain, sl.title))
+                       for sl in item.sitelinks})
+
+    def _all_domains(self) -> Set[Domain]:
+        return {primary_domain}.union(sl.domain for item in self.items.values() for sl in item.sitelinks)
+
+    def _sparql(self, query: str) -> str:
+        out = StringIO()
+        writer = csv.writer(out, lineterminator='\r\n')
+        if 'VALUES ?mw' in query:
+            values = query.split('VALUES ?mw', 1)[1].split('}', 1)[0]
+            urls = set(re.findall(r'<([^>]+)>', values))
+            writer.writerow(('id', 'sl', 'is_multi', 'is_non_multi'))
+            for qid, item in self.items.items():
+                if any(title_to_url(sl.domain, sl.title) in urls for sl in item.sitelinks):
+                    for sl in item.sitelinks:
+                        writer.writerow((_entity_prefix + qid, title_to_url(sl.domain, sl.title),
+                                         str(multi_site_class in item.classes).lower(),
+                                         str(non_multi_site_class in item.classes).lower()))
+        elif f'wdt:P31 wd:{multi_site_class}' in query:
+            writer.writerow(('id', 'sl'))
+            for qid, item in self.items.items():
+                if multi_site_class in item.classes:
+                    for sl in item.sitelinks:
+                        if sl.domain == primary_domain:
+                            writer.writerow((_entity_prefix + qid, title_to_url(sl.domain, sl.title)))
+        else:
+            raise ValueError('Unsupported query')
+        return out.getvalue()
+
+    def _add_change(self, domain: Domain, title: Title, ts: str, typ: str, **extras) -> None:
+        self.changes[domain].append(
+            dict(type=typ, ns=self._namespace(domain, title), title=title, timestamp=ts, **extras))
+
+    def _recent_changes(self, domain: Domain, params: Dict[str, str]) -> List[dict]:
+        if params.get('rcdir') != 'newer':
+            raise ValueError('Only rcdir=newer is supported')
+        start = params.get('rcstart')
+        namespaces = {int(v) for v in params['rcnamespace'].split('|')} if 'rcnamespace' in params else None
+        types = set(params['rctype'].split('|')) if 'rctype' in params else None
+        return [rc for rc in self.changes[domain]
+                if (not start or rc['timestamp'] >= start)
+                and (namespaces is None or rc['ns'] in namespaces)
+                and (types is None or rc['type'] in types)]
+
+    def _page(self, domain: Domain, title: Title, params: Dict[str, str]) -> dict:
+        history = self.pages[domain].get(title)
+        if not history:
+            return dict(title=title, missing=True)
+        page = dict(pageid=hash((domain, title)) & 0xFFFFFFF, title=title, lastrevid=history[-1].revid)
+        props = params.get('prop', '').split('|')
+        if 'info' in props and 'protection' in params.get('inprop', ''):
+            page['protection'] = []
+        if 'revisions' in props:
+            if 'rvlimit' in params:
+                start = params.get('rvstart')
+                revisions = [r for r in history if not start or r.ts >= start]
+            else:
+                revisions = history[-1:]
+            page['revisions'] = [self._revision(rev, params.get('rvprop', '').split('|')) for rev in revisions]
+        return page
+
+    def _revisions(self, domain: Domain, revids: Set[RevID], params: Dict[str, str]) -> List[dict]:
+        pages = []
+        for title, history in self.pages[domain].items():
+            revisions = [self._revision(rev, params.get('rvprop', '').split('|')) for rev in history
+                         if rev.revid in revids]
+            if revisions:
+                pages.append(dict(pageid=hash((domain, title)) & 0xFFFFFFF, title=title, revisions=revisions))
+        return pages
+
+    @staticmethod
+    def _revision(rev: RevComment, props: List[str]) -> dict:
+        result = dict(revid=rev.revid)
+        if 'user' in props:
+            result['user'] = rev.user
+        if 'comment' in props:
+            result['comment'] = rev.comment
+        if 'timestamp' in props:
+            result['timestamp'] = rev.ts
+        if 'content' in props:
+            result['slots'] = dict(main=dict(content=rev.content))
+        if 'sha1' in props:
+            result['sha1'] = calc_hash(rev.content)
+        return result
+
+
+def _site_id(domain: Domain) -> str:
+    if domain == primary_domain:
+        return 'mediawikiwiki'
+    lang, project, _ = domain.split('.')
+    return lang + ('wiki' if project == 'wikipedia' else project)
@@ -0,0 +1,292 @@
+import json
+import random
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter, sleep
+from typing import Dict, Any, Callable
+
+from requests import Session, Response
+from requests.adapters import BaseAdapter
+from urllib3 import HTTPResponse
+
+from dibabel.ChangeFeed import ChangeFeed
+from dibabel.Codec import CompactCodec, PickleCodec
+from dibabel.DataTypes import TitleSitelinks, SyncInfo, RevComment, SiteMetadata
+from dibabel.FetchPool import FetchPool
+from dibabel.MemoryCache import MemoryCache
+from dibabel.PageContent import PageContent
+from dibabel.Primary import Primary
+from dibabel.RevisionHistory import RevisionHistory
+from dibabel.SessionState import SessionState
+from dibabel.SitelinkSource import WdqsSitelinkSource, ApiSitelinkSource
+from dibabel.Sitelinks import Sitelinks
+from dibabel.Sparql import Sparql
+from StandInApi import StandInApi
+from dibabel.WikiSite import WikiSite
+
+
+def sample_objects() -> Dict[str, Any]:
+    """
+    Synthetic cache entries, sized similarly to the production cache
+    """
+    rnd = random.Random(42)
+    domains = [f'{lang}.wikipedia.org' for lang in (f'l{i}' for i in range(300))]
+    lines = [f'local v{i} = require("Module:Dep{i % 40}").call(frame, {i})\n' for i in range(1500)]
+
+    history = RevisionHistory()
+    for revid in range(200):
+        for _ in range(5):
+            lines[rnd.randrange(len(lines))] = f'-- changed in {revid}\n'
+        history.append(RevComment('User', '2020-01-01T00:00:00Z', f'edit {revid}', ''.join(lines), revid))
+
+    metadata = SiteMetadata(set(), set(), False, 'Template', 'Module')
+    primary = Primary('Q1', 'Module:Main')
+    primary.set_history(history, metadata)
+
+    primaries = {}
+    for i in range(1000):
+        primaries[f'Q{i}'] = Primary(f'Q{i}', f'Module:Main{i}')
+        primaries[f'Q{i}'].last_rev_id = 100000 + i
+        primaries[f'Q{i}'].dependencies = {f'Module:Dep{v}' for v in range(i % 40)}
+
+    return dict(
+        title_sitelinks={
+            f'Template:T{i}': TitleSitelinks(f'Q{i}', f'Template:T{i}', 'sync',
+                                             {d: f'Template:T{i}' for d in rnd.sample(domains, 100)})
+            for i in range(1000)},
+        info_by_qid={
+            d: SyncInfo('outdated', 'Q1', 'Module:Main', d, 'Module:Main', '2020-01-01T00:00:00Z', None, 199,
+                        ''.join(lines), 3, 196, 'a' * 40)
+            for d in domains},
+        page=PageContent('de.wikipedia.org', 'Modul:Main', 12345, ''.join(lines), '2020-01-01T00:00:00Z', None),
+        history=dict(history=primary.history, dependency_titles=primary.dependency_titles,
+                     revision_dependencies=primary.revision_dependencies,
+                     content_hashes=primary.content_hashes),
+        primaries_by_qid=(datetime.utcnow(), primaries),
+    )
+
+
+def measure(func: Callable[[], Any], repeat: int = 5) -> float:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_codecs():
+    codecs = dict(pickle=PickleCodec(), compact=CompactCodec(), compact_zlib=CompactCodec(use_zstd=False))
+    print(f'{"key":<20}{"codec":<15}{"bytes":>12}{"save ms":>10}{"load ms":>10}')
+    for key, value in sample_objects().items():
+        for name, codec in codecs.items():
+            data = codec.encode(value)
+            save = measure(lambda: codec.encode(value))
+            load = measure(lambda: codec.decode(data))
+            print(f'{key:<20}{name:<15}{len(data):>12}{save * 1000:>10.2f}{load * 1000:>10.2f}')
+
+
+def benchmark_cache_writes(count: int = 5000):
+    """
+    Save many small pages, the way the refresher does, with and without the write-behind mode.
+    Requires a local Redis server.
+    """
+    lines = [f'local v{i} = require("Module:Dep{i % 40}").call(frame, {i})\n' for i in range(100)]
+    pages = [PageContent('de.wikipedia.org', f'Modul:Page{i}', i, ''.join(lines), '2020-01-01T00:00:00Z', None)
+             for i in range(count)]
+    print(f'{"mode":<15}{"saves/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}{"flush ms":>10}')
+    for mode, write_behind in (('autocommit', False), ('write-behind', True)):
+        with tempfile.TemporaryDirectory() as folder:
+            with SessionState(Path(folder) / 'cache.sqlite', 'benchmark', 'localhost',
+                              write_behind=write_behind) as state:
+                latencies = []
+                start = perf_counter()
+                for page in pages:
+                    begin = perf_counter()
+                    state.save_obj(f'page:{page.domain}:{page.title}', page)
+                    latencies.append(perf_counter() - begin)
+                flush_start = perf_counter()
+                state.flush()
+                flush = perf_counter() - flush_start
+                elapsed = perf_counter() - start
+                state.delete_cached_items('page:')
+        latencies.sort()
+        print(f'{mode:<15}{count / elapsed:>10.0f}{latencies[len(latencies) // 2] * 1000:>10.2f}'
+              f'{latencies[len(latencies) * 99 // 100] * 1000:>10.2f}{latencies[-1] * 1000:>10.2f}'
+              f'{flush * 1000:>10.2f}')
+
+
+def benchmark_refresh_fetch(domains: int = 300):
+    """
+    Wall-clock time of downloading the copies from all wikis during a refresh, with simulated API latency:
+    one request to verify the cached revisions, and one request per 50 pages to download the changed ones
+    """
+    rnd = random.Random(42)
+    work = [(f'l{i}.wikipedia.org', [rnd.uniform(0.02, 0.2) for _ in range(1 + rnd.randrange(50) // 40)])
+            for i in range(domains)]
+
+    def fetch(domain, latencies):
+        for latency in latencies:
+            sleep(latency)
+        return domain
+
+    print(f'{"workers":>8}{"per host":>10}{"seconds":>10}')
+    for workers, per_host in ((1, 1), (4, 2), (16, 2), (32, 2)):
+        start = perf_counter()
+        with FetchPool(workers, per_host) as pool:
+            result = list(pool.imap((domain, lambda d=domain, l=latencies: fetch(d, l)) for domain, latencies in work))
+        elapsed = perf_counter() - start
+        assert result == [domain for domain, _ in work]
+        print(f'{workers:>8}{per_host:>10}{elapsed:>10.2f}')
+
+
+def benchmark_change_feed(domains: int = 20, titles: int = 500, edits: int = 10):
+    """
+    API requests and response sizes needed to find the changed copies during a refresh, by checking the latest
+    revision of every tracked page, or by reading the recent changes since the previous refresh.
+    Uses the stand-in API, with a few edits per wiki between the refreshes.
+    """
+    rnd = random.Random(42)
+    api = StandInApi()
+    session = Session()
+    session.mount('https://', api)
+    sites = [WikiSite(f'l{i}.wikipedia.org', session, False) for i in range(domains)]
+    tracked = [f'Module:Page{i}' for i in range(titles)]
+    for site in sites:
+        for title in tracked:
+            api.edit(site.domain, title, f'return "{title}"', ts=datetime.utcnow() - timedelta(days=1))
+    since = datetime.utcnow() - timedelta(hours=1)
+    for site in sites:
+        for title in rnd.sample(tracked, edits):
+            api.edit(site.domain, title, f'return "{title} edited"')
+
+    def by_revision():
+        return {site.domain: {title for title, revid in site.query_pages_revid(tracked)
+                              if revid != api.pages[site.domain][title][0].revid}
+                for site in sites}
+
+    def by_feed():
+        return {site.domain: site.query_recent_changes(since, ChangeFeed.namespaces).intersection(tracked)
+                for site in sites}
+
+    print(f'{"method":<12}{"requests":>10}{"KB":>10}{"changed":>10}{"seconds":>10}')
+    results = []
+    for name, func in (('revisions', by_revision), ('feed', by_feed)):
+        api.reset_counters()
+        start = perf_counter()
+        changed = func()
+        elapsed = perf_counter() - start
+        results.append(changed)
+        print(f'{name:<12}{sum(api.requests.values()):>10}{sum(api.response_bytes.values()) / 1024:>10.1f}'
+              f'{sum(len(v) for v in changed.values()):>10}{elapsed:>10.2f}')
+    assert results[0] == results[1]
+
+
+def benchmark_sitelinks_refresh():
+    """
+    Total time to refresh the sitelinks of all primary pages, with the Wikidata Query Service split into queries
+    of different sizes, and with the Wikidata API.
+    Requires a local Redis server, and access to mediawiki.org, Wikidata, and the Wikidata Query Service.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        with SessionState(Path(folder) / 'cache.sqlite', 'benchmark', 'localhost') as state:
+            titles = [sl.title for sl in state.sitelink_source.query_primaries([])]
+            print(f'{len(titles)} titles')
+            wikidata = state.get_site('www.wikidata.org')
+            sources = [
+                *((f'wdqs {max_values}x{workers}',
+                   WdqsSitelinkSource(Sparql(session=state.session, max_values=max_values, max_workers=workers,
+                                             cache=None)))
+                  for max_values, workers in ((len(titles), 1), (500, 1), (200, 1), (200, 4), (100, 4))),
+                *((f'api 50x{workers}', ApiSitelinkSource(wikidata, workers)) for workers in (1, 4)),
+            ]
+            print(f'{"source":<16}{"seconds":>10}')
+            for name, source in sources:
+                state.sitelink_source = source
+                start = perf_counter()
+                Sitelinks(state, []).refresh(titles, force=True)
+                print(f'{name:<16}{perf_counter() - start:>10.2f}')
+            state.delete_cached_items('title_sitelinks:')
+            state.delete_cached_items('title_fetched:')
+
+
+class FixedResponse(BaseAdapter):
+    """
+    Returns the same response body to every request, streamed like a real response
+    """
+
+    def __init__(self, body: bytes):
+        super().__init__()
+        self.body = body
+
+    def send(self, request, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response.raw = HTTPResponse(body=BytesIO(self.body), preload_content=False)
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def benchmark_sparql_memory(rows: int = 100000):
+    """
+    Peak memory used to read a large Wikidata query result, such as all sitelinks of the primary pages,
+    as the whole JSON response, and as CSV rows parsed while the response is being read
+    """
+    items = [(f'http://www.wikidata.org/entity/Q{i // 50}', f'https://l{i % 50}.wikipedia.org/wiki/Module:Page{i}',
+              'true', 'false') for i in range(rows)]
+    variables = ('id', 'sl', 'is_multi', 'is_non_multi')
+    json_body = json.dumps(dict(head=dict(vars=variables), results=dict(bindings=[
+        {k: dict(type='literal', value=v) for k, v in zip(variables, item)} for item in items]))).encode()
+    csv_body = ('\r\n'.join(','.join(v) for v in [variables, *items]) + '\r\n').encode()
+    del items
+
+    def read_json():
+        session = Session()
+        session.mount('https://', FixedResponse(json_body))
+        r = session.post('https://query.wikidata.org/sparql')
+        return sum(1 for row in r.json()['results']['bindings'] if row['sl']['value'])
+
+    def read_csv(cache):
+        session = Session()
+        session.mount('https://', FixedResponse(csv_body))
+        sparql = Sparql(session=session, cache=cache)
+        return sum(1 for _, sl, _, _ in sparql.query('SELECT ...') if sl)
+
+    print(f'{"format":<12}{"rows":>10}{"peak MB":>10}{"seconds":>10}')
+    for name, func in (('json', read_json),
+                       ('csv', lambda: read_csv(None)),
+                       ('csv cached', lambda: read_csv(MemoryCache()))):
+        tracemalloc.start()
+        start = perf_counter()
+        count = func()
+        elapsed = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:<12}{count:>10}{peak / 1024 / 1024:>10.1f}{elapsed:>10.2f}')
+
+
+benchmarks = dict(
+    codecs=benchmark_codecs,
+    cache_writes=benchmark_cache_writes,
+    refresh_fetch=benchmark_refresh_fetch,
+    change_feed=benchmark_change_feed,
+    sitelinks_refresh=benchmark_sitelinks_refresh,
+    sparql_memory=benchmark_sparql_memory,
+)
+
+
+def main(names):
+    for name in names or benchmarks.keys():
+        print(f'==== {name}')
+        benchmarks[name]()
+
+
+main(sys.argv[1:])
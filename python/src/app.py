@@ -44,21 +44,19 @@ allowed_domain = set((v["url"].replace("https://", "") for v in json.loads(site_
 
 def refresher():
     if not is_shutting_down:
-        print(f'Refreshing state at {datetime.utcnow()}...')
-        with create_session(user_requested=False) as state:
-            Controller(state).refresh_state()
+        with create_session(user_requested=False, sitelink_source=app.config['SITELINK_SOURCE']) as state:
+            # Revalidations of stale values and the refreshers of other processes update the same state
+            if not state.lock_refresh():
+                print(f'Skipping refresh at {datetime.utcnow()}, another refresh is running')
+                return
+            try:
+                print(f'Refreshing state at {datetime.utcnow()}...')
+                Controller(state).refresh_state()
+            finally:
+                state.unlock_refresh()
         print(f'Done refreshing state at {datetime.utcnow()}...')
 
 
-# Refresh state during startup, before serving any requests
-refresher()
-
-# Make sure we have the latest data by occasionally refreshing it
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=refresher, trigger="interval", seconds=300)
-scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
-
 app = Flask(__name__)
 
 for file in ('default.yaml', 'secret.yaml'):
@@ -69,6 +67,15 @@ for file in ('default.yaml', 'secret.yaml'):
 
 print(f"Running as {app.config['CONSUMER_KEY']}")
 
+# Refresh state during startup, before serving any requests
+refresher()
+
+# Make sure we have the latest data by occasionally refreshing it
+scheduler = BackgroundScheduler()
+scheduler.add_job(func=refresher, trigger="interval", seconds=300)
+scheduler.start()
+atexit.register(lambda: scheduler.shutdown())
+
 
 def _create_consumer_token():
     return mwoauth.ConsumerToken(app.config["CONSUMER_KEY"], app.config["CONSUMER_SECRET"])
@@ -84,7 +91,7 @@ def after_request(response):
 def get_data():
     _validate_not_stopping()
     print(f"++++ /data")
-    with create_session(user_requested=True) as state:
+    with create_session(user_requested=True, sitelink_source=app.config['SITELINK_SOURCE']) as state:
         return jsonify(Controller(state).get_data())
 
 
@@ -93,7 +100,7 @@ def get_page(qid: str, domain: str):
     _validate_not_stopping()
     print(f"++++ /page/{qid}/{domain}")
     _validate_domain(domain)
-    with create_session(user_requested=True) as state:
+    with create_session(user_requested=True, sitelink_source=app.config['SITELINK_SOURCE']) as state:
         return jsonify(Controller(state).get_page(qid, domain))
 
 
@@ -140,7 +147,7 @@ def call_api(domain: str):
                   resource_owner_key=access_token.key,
                   resource_owner_secret=access_token.secret)
 
-    with create_session(user_requested=True) as state:
+    with create_session(user_requested=True, sitelink_source=app.config['SITELINK_SOURCE']) as state:
         site = state.get_site(domain)
         params = request.get_json()
         action = params.pop('action')
@@ -0,0 +1,89 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Dict, Optional, Set, List, Tuple, Iterable, Callable
+
+from pywikiapi import AttrDict
+
+from .DataTypes import Domain, Title, RecentChangesCursor
+from .FetchPool import FetchPool
+from .Schema import key_family
+from .SessionState import SessionState
+from .WikiSite import WikiSite
+from .utils import is_older_than
+
+
+@dataclass
+class WikiChanges:
+    # Titles changed since the previous poll, or None if they are not known because there was no usable cursor
+    titles: Optional[Set[Title]]
+    # If true, all tracked pages must be verified regardless of the changed titles
+    verify_all: bool
+
+
+class ChangeFeed:
+    """
+    Keeps a recentchanges cursor for each wiki, to find which pages have changed since the previous refresh,
+    instead of checking the latest revision of every tracked page. Whatever the caller has cached about the changed
+    pages is no longer valid. Once in a while, and whenever the cursor is missing or too old, all tracked pages
+    must be verified instead, in case some change was missed.
+    Cursors are only advanced by commit(), after the caller has processed the changes.
+    """
+    _cache_prefix = 'recentchanges:'
+    # Template and Module namespaces, unless given otherwise
+    namespaces = (10, 828)
+    # Wikis keep recent changes for at least 30 days, but there is no point in catching up after a long break
+    _max_age = timedelta(days=7)
+    # A change may appear in the feed a bit after its timestamp, e.g. because of the database replication lag
+    _overlap = timedelta(minutes=5)
+
+    def __init__(self, state: SessionState, name: str,
+                 namespaces: Iterable[int] = None,
+                 reconcile_interval: timedelta = timedelta(hours=6),
+                 rc_filter: Callable[[AttrDict], bool] = None,
+                 reconcile_titles: bool = True):
+        self._state = state
+        # Each user of the feed has its own cursors
+        self._prefix = f'{self._cache_prefix}{name}:'
+        if namespaces is not None:
+            self.namespaces = tuple(namespaces)
+        self._reconcile_interval = reconcile_interval
+        # Only the changes accepted by this filter are reported. It runs in a pool thread.
+        self._rc_filter = rc_filter
+        # Whether the caller needs the changed titles when it verifies all pages. If not, the feed is not queried then.
+        self._reconcile_titles = reconcile_titles
+        self._new_cursors: Dict[Domain, RecentChangesCursor] = {}
+
+    def poll(self, sites: List[WikiSite]) -> Dict[Domain, WikiChanges]:
+        """
+        Get the changes of all given wikis, querying several wikis at once
+        """
+        cursors = self._state.load_many(self._prefix + site.domain for site in sites)
+        result = {}
+        with FetchPool() as pool:
+            for site, (changes, cursor) in zip(sites, pool.imap(
+                    (site.domain, partial(self._poll, site, cursors.get(self._prefix + site.domain)))
+                    for site in sites)):
+                result[site.domain] = changes
+                self._new_cursors[site.domain] = cursor
+        return result
+
+    def commit(self) -> None:
+        self._state.save_many({self._prefix + domain: cursor for domain, cursor in self._new_cursors.items()})
+        self._new_cursors.clear()
+
+    def _poll(self, site: WikiSite,
+              cursor: Optional[RecentChangesCursor]) -> Tuple[WikiChanges, RecentChangesCursor]:
+        # Runs in a pool thread, so it must not use the cache
+        now = datetime.utcnow()
+        if cursor is None or is_older_than(cursor.since, self._max_age):
+            return WikiChanges(None, True), RecentChangesCursor(now - self._overlap, now)
+        if is_older_than(cursor.reconciled, self._reconcile_interval):
+            titles = site.query_recent_changes(cursor.since, self.namespaces, self._rc_filter) \
+                if self._reconcile_titles else None
+            return WikiChanges(titles, True), RecentChangesCursor(now - self._overlap, now)
+        titles = site.query_recent_changes(cursor.since, self.namespaces, self._rc_filter)
+        return WikiChanges(titles, False), RecentChangesCursor(now - self._overlap, cursor.reconciled)
+
+
+key_family(ChangeFeed._cache_prefix)
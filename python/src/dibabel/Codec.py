@@ -0,0 +1,213 @@
+import copyreg
+import io
+import pickle
+import zlib
+from collections import OrderedDict
+from dataclasses import is_dataclass, fields
+from functools import partial
+from typing import Any, Dict, Tuple, Type, Callable, TypeVar, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+T = TypeVar('T')
+
+# Registered classes: type -> (tag, schema version), and tag -> (type, schema version)
+_types_by_class: Dict[type, Tuple[str, int]] = {}
+_types_by_tag: Dict[str, Tuple[type, int]] = {}
+
+
+class SchemaError(ValueError):
+    """The stored value was encoded with a different schema version of a class, or an unknown class"""
+    pass
+
+
+def serializable(tag: str, version: int = 1) -> Callable[[Type[T]], Type[T]]:
+    """
+    Class decorator to allow the class in the compact codec. Increment the version whenever the class layout changes,
+    together with the version of the key families that store the class (see Schema.key_family). Their upgrade
+    functions get the objects of the older layout as OutdatedState, and must restore each of them.
+    Dataclasses are stored as a tuple of their field values, other classes as their __getstate__() or __dict__.
+    """
+
+    def register(cls: Type[T]) -> Type[T]:
+        if tag in _types_by_tag:
+            raise ValueError(f'Serialization tag {tag} is already used by {_types_by_tag[tag][0]}')
+        _types_by_class[cls] = (tag, version)
+        _types_by_tag[tag] = (cls, version)
+        return cls
+
+    return register
+
+
+class OutdatedState:
+    """
+    An object of a registered class, stored with an older schema version of the class.
+    It is only decoded while upgrading a value of an older key family version.
+    """
+
+    def __init__(self, tag: str, version: int, state: Any):
+        self.tag = tag
+        self.version = version
+        # Field values of a dataclass, or the __getstate__() of other classes, in the layout of that version
+        self.state = state
+        self.restored = False
+
+    def restore(self, state: Any) -> Any:
+        """
+        Create the object from its state converted to the current layout
+        """
+        self.restored = True
+        return _create(_types_by_tag[self.tag][0], state)
+
+
+def _restore(tag: str, version: int, state: Any, outdated: Optional[List[OutdatedState]] = None) -> Any:
+    try:
+        cls, expected_version = _types_by_tag[tag]
+    except KeyError:
+        raise SchemaError(f'Unknown serialization tag {tag}')
+    if version != expected_version:
+        if outdated is None or version > expected_version:
+            raise SchemaError(f'{tag} was stored with schema version {version}, expected {expected_version}')
+        value = OutdatedState(tag, version, state)
+        outdated.append(value)
+        return value
+    return _create(cls, state)
+
+
+def _create(cls: type, state: Any) -> Any:
+    if is_dataclass(cls):
+        return cls(*state)
+    value = cls.__new__(cls)
+    if hasattr(value, '__setstate__'):
+        value.__setstate__(state)
+    else:
+        value.__dict__.update(state)
+    return value
+
+
+def _decompress_bytes(method: str, data: bytes) -> bytes:
+    if method == 'zstd':
+        if not zstandard:
+            raise SchemaError('zstandard package is required to decode this value')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _decompress(method: str, data: bytes) -> str:
+    return _decompress_bytes(method, data).decode()
+
+
+class _Compressed:
+    def __init__(self, method: str, data: bytes):
+        self.method = method
+        self.data = data
+
+
+class _Unpickler(pickle.Unpickler):
+    # Only the builtin containers and the registered classes (via _restore) can be loaded
+    _allowed = {
+        ('dibabel.Codec', '_decompress'): _decompress,
+        ('collections', 'OrderedDict'): OrderedDict,
+    }
+
+    def __init__(self, file, outdated: Optional[List[OutdatedState]]):
+        super().__init__(file)
+        self._outdated = outdated
+
+    def find_class(self, module, name):
+        if (module, name) == ('dibabel.Codec', '_restore'):
+            return partial(_restore, outdated=self._outdated)
+        try:
+            return self._allowed[(module, name)]
+        except KeyError:
+            if module == 'datetime' and name in ('datetime', 'date', 'timedelta'):
+                return super().find_class(module, name)
+            raise SchemaError(f'{module}.{name} is not allowed in the compact codec')
+
+
+class PickleCodec:
+    def encode(self, value: Any) -> bytes:
+        return pickle.dumps(value)
+
+    def decode(self, data: bytes, outdated: List[OutdatedState] = None) -> Any:
+        return pickle.loads(data)
+
+
+class CompactCodec:
+    """
+    Pickle-based encoding, where every registered class is stored as a schema tag and version with its field values,
+    rather than a reference to the class and its raw __dict__, so that the stored data does not depend on
+    module paths and class internals. Long strings in the objects' fields are compressed individually,
+    and so is the whole payload if it is large.
+    Values stored by the PickleCodec are still decoded, so the cache does not need to be wiped.
+    """
+    _header = b'C'
+    _plain, _zlib, _zstd = b'\x01', b'\x02', b'\x03'
+
+    def __init__(self, compress_min_size: int = 2048, compress_payload_min_size: int = 65536,
+                 use_zstd: bool = True, zlib_level: int = 1):
+        # Strings at least this long (in characters) are compressed
+        self.compress_min_size = compress_min_size
+        # Encoded values at least this long (in bytes) are compressed as a whole
+        self.compress_payload_min_size = compress_payload_min_size
+        self.zlib_level = zlib_level
+        self._zstd_compressor = zstandard.ZstdCompressor() if use_zstd and zstandard else None
+        self._dispatch_table = copyreg.dispatch_table.copy()
+        self._dispatch_table[_Compressed] = lambda v: (_decompress, (v.method, v.data))
+
+    def encode(self, value: Any) -> bytes:
+        for cls in _types_by_class.keys():
+            if cls not in self._dispatch_table:
+                self._dispatch_table[cls] = self._reduce
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=4)
+        pickler.dispatch_table = self._dispatch_table
+        pickler.dump(value)
+        payload = buffer.getvalue()
+        if len(payload) < self.compress_payload_min_size:
+            return self._header + self._plain + payload
+        if self._zstd_compressor:
+            return self._header + self._zstd + self._zstd_compressor.compress(payload)
+        return self._header + self._zlib + zlib.compress(payload, self.zlib_level)
+
+    def decode(self, data: bytes, outdated: List[OutdatedState] = None) -> Any:
+        """
+        Objects of an older schema version of their class are decoded as OutdatedState and added to the outdated list,
+        or raise SchemaError if it is not given
+        """
+        if data[:1] != self._header:
+            # Stored by the pickle codec
+            return pickle.loads(data)
+        method = data[1:2]
+        payload = memoryview(data)[2:]
+        if method == self._zlib:
+            payload = zlib.decompress(payload)
+        elif method == self._zstd:
+            payload = _decompress_bytes('zstd', payload)
+        elif method != self._plain:
+            raise SchemaError(f'Unknown compact codec payload type {method}')
+        return _Unpickler(io.BytesIO(payload), outdated).load()
+
+    def _reduce(self, obj: Any):
+        tag, version = _types_by_class[type(obj)]
+        if is_dataclass(obj):
+            state = tuple(self._pack(getattr(obj, f.name), 1) for f in fields(obj))
+        else:
+            get_state = getattr(obj, '__getstate__', None)
+            state = self._pack(get_state() if get_state else obj.__dict__, 3)
+        return _restore, (tag, version, state)
+
+    def _pack(self, value: Any, depth: int) -> Any:
+        # Compress long strings, looking into the nested dictionaries up to the given depth
+        if type(value) is str:
+            if len(value) < self.compress_min_size:
+                return value
+            if self._zstd_compressor:
+                return _Compressed('zstd', self._zstd_compressor.compress(value.encode()))
+            return _Compressed('zlib', zlib.compress(value.encode(), self.zlib_level))
+        if depth > 1 and isinstance(value, dict):
+            return type(value)((k, self._pack(v, depth - 1)) for k, v in value.items())
+        return value
@@ -26,7 +26,7 @@ class Controller:
     def get_page(self, qid: QID, domain: Domain) -> Optional[dict]:
         page, info = self._synchronizer.update_syncinfo(qid, domain)
         result = self._synchronizer.get_syncinfo(qid)
-        primary = self._primaries.get_page(qid)
+        primary = self._primaries.get_page(qid, load_history=True)
 
         content = dict(
             changeType=info.status,
@@ -56,3 +56,5 @@ class Controller:
         self._metadata.refresh()
         # Download content of all copies and compute sync info
         self._synchronizer.update_syncinfo()
+        # Commit everything the refresh has written to the backing store
+        self._state.flush()
@@ -1,5 +1,9 @@
-from dataclasses import dataclass
-from typing import Dict, List, Set, Optional, NewType
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Set, Optional, NewType, Iterable
+
+from .Codec import serializable
 
 QID = NewType('QID', str)
 Domain = NewType('Domain', str)
@@ -8,6 +12,7 @@ RevID = NewType('RevID', int)
 Timestamp = NewType('Timestamp', str)
 
 
+@serializable('WdSitelink')
 @dataclass
 class WdSitelink:
     qid: QID
@@ -15,6 +20,7 @@ class WdSitelink:
     title: Title
 
 
+@serializable('TitleSitelinks')
 @dataclass
 class TitleSitelinks:
     qid: Optional[QID]
@@ -28,12 +34,19 @@ class TitleSitelinks:
     domain_to_title: Dict[Domain, Title]
 
 
+@serializable('WdWarning')
 @dataclass
 class WdWarning:
     qid: QID
     url: str
 
 
+def _alternation(values: Iterable[str]) -> str:
+    # Longer values first, so that a prefix never shadows a longer match. Empty set never matches.
+    return '|'.join(re.escape(v) for v in sorted(values, key=lambda v: (-len(v), v))) or '(?!)'
+
+
+@serializable('SiteMetadata')
 @dataclass
 class SiteMetadata:
     magic_words: Set[str]
@@ -41,11 +54,54 @@ class SiteMetadata:
     flagged_revisions: bool
     template_ns: str
     module_ns: str
-
-    def is_magic_keyword(self, name: Title):
-        return name in self.magic_words or any(v for v in self.magic_prefixes if name.startswith(v))
-
-
+    # All names of the Template and Module namespaces - canonical, localized, and aliases
+    template_aliases: Set[str] = field(default_factory=set)
+    module_aliases: Set[str] = field(default_factory=set)
+
+    def __post_init__(self):
+        self._compile()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['matcher']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def _compile(self):
+        # Classifies the name used in a template call or a require() with a single anchored match
+        self.matcher = re.compile(
+            rf'(?P<magic>(?:{_alternation(self.magic_words)})$|{_alternation(self.magic_prefixes)})'
+            rf'|(?:(?P<template>(?i:{_alternation(self.template_aliases)}))'
+            rf'|(?P<module>(?i:{_alternation(self.module_aliases)})))\s*:\s*(?P<name>[^:]+)$'
+            rf'|(?P<plain>[^:]+)$')
+
+    def is_magic_keyword(self, name: str) -> bool:
+        m = self.matcher.match(name)
+        return m is not None and m.group('magic') is not None
+
+    def template_name(self, name: str) -> Optional[Title]:
+        """
+        Normalized title of the template called as {{name}}, or None if it is a magic word or not a template
+        """
+        m = self.matcher.match(name)
+        if m is None or m.group('magic') is not None or m.group('module') is not None:
+            return None
+        return 'Template:' + (m.group('name') if m.group('template') is not None else name)
+
+    def module_name(self, name: str) -> Title:
+        """
+        Module title with the canonical namespace if it uses any of the Module namespace names
+        """
+        m = self.matcher.match(name)
+        if m is not None and m.group('module') is not None:
+            return 'Module:' + m.group('name')
+        return name
+
+
+@serializable('RevComment')
 @dataclass
 class RevComment:
     user: str
@@ -55,6 +111,7 @@ class RevComment:
     revid: RevID
 
 
+@serializable('SyncInfo')
 @dataclass
 class SyncInfo:
     status: str  # 'ok' | 'outdated' | 'unlocalized' | 'diverged' | 'new'
@@ -75,4 +132,13 @@ class SyncInfo:
                f"({self.dst_revid}, #{self.hash})"
 
 
+@serializable('RecentChangesCursor')
+@dataclass
+class RecentChangesCursor:
+    # Changes since this time have not been processed yet
+    since: datetime
+    # Last time all tracked pages were verified regardless of the recent changes
+    reconciled: datetime
+
+
 Translations = Dict[str, Dict[str, str]]
@@ -0,0 +1,89 @@
+import threading
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Iterable, Iterator, Tuple, TypeVar, Dict, Deque
+
+T = TypeVar('T')
+
+
+class FetchPool:
+    """
+    Runs network requests concurrently, with a limit on the number of concurrent requests to each host,
+    and on the total number of requests. The results are returned in the order of the requests,
+    regardless of which one finishes first, so the callers process them deterministically.
+    """
+
+    def __init__(self, max_workers: int = 16, max_per_host: int = 2, window: int = None):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        # How many requests can be started ahead of the one whose result is being waited for.
+        # This limits the memory used by the results that have not been processed yet.
+        self.window = window or max_workers * 4
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch')
+        self._lock = threading.Lock()
+        self._active: Dict[str, int] = defaultdict(int)
+        self._queued: Dict[str, Deque[Tuple[Callable[[], T], Future]]] = defaultdict(deque)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for queue in self._queued.values():
+                for _, future in queue:
+                    future.cancel()
+            self._queued.clear()
+        self._executor.shutdown(wait=True)
+
+    def submit(self, host: str, func: Callable[[], T]) -> Future:
+        """
+        Run func() once there is a free slot for the host
+        """
+        future = Future()
+        with self._lock:
+            self._queued[host].append((func, future))
+            self._start_queued(host)
+        return future
+
+    def imap(self, requests: Iterable[Tuple[str, Callable[[], T]]]) -> Iterator[T]:
+        """
+        Run (host, func) requests concurrently, and yield the results of func() in the order of the requests.
+        The requests are taken from the iterable by the calling thread, only when there is room in the window.
+        """
+        pending: Deque[Future] = deque()
+        requests = iter(requests)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.window:
+                try:
+                    host, func = next(requests)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append(self.submit(host, func))
+            if not pending:
+                return
+            yield pending.popleft().result()
+
+    def _start_queued(self, host: str) -> None:
+        # Must be called with the lock held
+        queue = self._queued.get(host)
+        while queue and self._active[host] < self.max_per_host:
+            func, future = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._active[host] += 1
+            self._executor.submit(self._run, host, func, future)
+
+    def _run(self, host: str, func: Callable[[], T], future: Future) -> None:
+        try:
+            future.set_result(func())
+        except BaseException as err:
+            future.set_exception(err)
+        finally:
+            with self._lock:
+                self._active[host] -= 1
+                self._start_queued(host)
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from typing import Tuple, Optional, Dict
+
+from .Codec import serializable
+from .DataTypes import RevID, Title
+
+# Sorted pairs of (dependency title, its title in the target domain), only for the localized dependencies
+DependencyMapping = Tuple[Tuple[Title, Title], ...]
+
+
+# Size of a binary SHA1 digest
+digest_size = 20
+
+
+@serializable('LocalizationCache')
+class LocalizationCache:
+    """
+    Localized content of the historic revisions of a page.
+    Localized content only depends on how the revision's dependencies map to the target domain titles,
+    so entries are keyed by the mapping rather than the domain, and shared by all domains with the same mapping.
+    Renaming or (un)linking a dependency produces a new mapping, and the old entry is eventually evicted.
+    Only the hashes of the localized content of every revision are stored, for the most recently used localization
+    groups. The content itself is kept in a size-bounded LRU cache in memory, and localized again when needed.
+    """
+
+    def __init__(self, max_entries: int = 2000, max_size: int = 10_000_000, max_groups: int = 100):
+        self.max_entries = max_entries
+        # Total length of all cached content, in characters
+        self.max_size = max_size
+        self.max_groups = max_groups
+        self.modified = False
+        self._size = 0
+        self._entries: Dict[Tuple[RevID, DependencyMapping], str] = OrderedDict()
+        # Localization group -> concatenated SHA1 digests of the localized content of each revision, in history order
+        self._hashes: Dict[DependencyMapping, bytes] = OrderedDict()
+
+    def __getstate__(self):
+        return dict(max_entries=self.max_entries, max_size=self.max_size, max_groups=self.max_groups,
+                    hashes=self._hashes)
+
+    def __setstate__(self, state):
+        self.__init__(state['max_entries'], state['max_size'], state['max_groups'])
+        self._hashes.update(state['hashes'])
+
+    def copy(self) -> 'LocalizationCache':
+        """
+        A cache with the same stored hashes and no content, which can be modified without changing this one
+        """
+        cache = LocalizationCache.__new__(LocalizationCache)
+        cache.__setstate__(self.__getstate__())
+        return cache
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, revid: RevID, mapping: DependencyMapping) -> Optional[str]:
+        key = (revid, mapping)
+        try:
+            content = self._entries[key]
+        except KeyError:
+            return None
+        self._entries.move_to_end(key)
+        return content
+
+    def put(self, revid: RevID, mapping: DependencyMapping, content: str) -> None:
+        key = (revid, mapping)
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._entries[key] = content
+        self._size += len(content)
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_size):
+            _, old_content = self._entries.popitem(last=False)
+            self._size -= len(old_content)
+
+    def get_hashes(self, group: DependencyMapping) -> bytes:
+        """
+        Digests of the localized content of the first revisions in history, digest_size bytes each
+        """
+        try:
+            hashes = self._hashes[group]
+        except KeyError:
+            return b''
+        self._hashes.move_to_end(group)
+        return hashes
+
+    def set_hashes(self, group: DependencyMapping, hashes: bytes) -> None:
+        self._hashes.pop(group, None)
+        self._hashes[group] = hashes
+        self.modified = True
+        while len(self._hashes) > self.max_groups:
+            self._hashes.popitem(last=False)
+
+    def clear_hashes(self) -> None:
+        """
+        Forget the hashes of all groups, when the revisions are parsed again
+        """
+        if self._hashes:
+            self._hashes.clear()
+            self.modified = True
@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Dict, Tuple, Optional, Iterable
+from uuid import uuid4
+
+from redis import Redis
+
+
+class _Pool:
+    """
+    Entries of one kind, evicted in LRU order once either of the limits is exceeded
+    """
+
+    def __init__(self, max_entries: int, max_size: int):
+        self.max_entries = max_entries
+        # Total size of the encoded values, in bytes
+        self.max_size = max_size
+        self.size = 0
+        # key -> (value, encoded size, time added)
+        self.entries: Dict[str, Tuple[Any, int, float]] = OrderedDict()
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (value, size, monotonic())
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_size:
+            _, (_, old_size, _) = self.entries.popitem(last=False)
+            self.size -= old_size
+
+    def remove(self, key: str) -> None:
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+
+class MemoryCache:
+    """
+    Process-wide LRU cache of decoded objects, placed in front of Redis.
+    Bounded by the number of entries and by their approximate (encoded) size.
+    The fields of sharded values are small and numerous, so they are kept in a separate pool with its own limits,
+    and loading many of them does not evict the large objects that are shared by all requests.
+    All processes publish the keys they modify to a Redis channel, and every process evicts them on receipt.
+    The objects are shared by all sessions of the process, so they must not be modified without saving them.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_size: int = 256 * 1024 * 1024,
+                 max_fields: int = 100_000, max_fields_size: int = 64 * 1024 * 1024, max_age: float = 300):
+        self._objects = _Pool(max_entries, max_size)
+        self._fields = _Pool(max_fields, max_fields_size)
+        # Safety net in case an invalidation message gets lost, e.g. while reconnecting to Redis
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # Identifies the messages of this process, picked again by subscribe() in every forked process
+        self._sender: Optional[str] = None
+        self._channel: Optional[str] = None
+        self._redis: Optional[Redis] = None
+        self._thread = None
+        self._pid = None
+
+    def get(self, key: str, default: Any = None, field: bool = False) -> Any:
+        pool = self._fields if field else self._objects
+        with self._lock:
+            try:
+                value, _, added = pool.entries[key]
+            except KeyError:
+                return default
+            if monotonic() - added > self.max_age:
+                pool.remove(key)
+                return default
+            pool.entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, size: int, field: bool = False) -> None:
+        pool = self._fields if field else self._objects
+        if size > pool.max_size:
+            return
+        with self._lock:
+            pool.put(key, value, size)
+
+    def invalidate(self, keys: Iterable[str], publish: bool = True) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        with self._lock:
+            for key in keys:
+                for pool in (self._objects, self._fields):
+                    if key in pool.entries:
+                        pool.remove(key)
+        if publish and self._redis is not None:
+            # Sender ID, followed by one key per line
+            self._redis.publish(self._channel, '\n'.join([self._sender] + keys))
+
+    def subscribe(self, redis: Redis, channel: str) -> None:
+        """
+        Start listening for invalidations from other processes, unless already listening in this process.
+        """
+        with self._lock:
+            # The listener thread does not survive a fork of the process, e.g. by uwsgi after loading the app
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._objects.clear()
+            self._fields.clear()
+            # The random module state is copied by fork, uuid4 is not
+            self._sender = uuid4().hex
+            self._redis = redis
+            self._channel = channel
+            self._pid = os.getpid()
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{channel: self._on_message})
+            self._thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _on_message(self, message) -> None:
+        sender, *keys = message['data'].decode().split('\n')
+        if sender != self._sender:
+            self.invalidate(keys, publish=False)
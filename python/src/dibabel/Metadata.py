@@ -2,6 +2,7 @@ from datetime import datetime, timedelta
 from typing import Dict
 
 from .DataTypes import SiteMetadata, Domain
+from .Schema import key_family
 from .SessionState import SessionState
 from .utils import is_older_than
 
@@ -12,10 +13,14 @@ class Metadata:
 
     def __init__(self, state: SessionState):
         self._state = state
-        ts, val = state.load_obj(self._cache_key, (None, None))
+        val, ts, _ = state.load_timed(self._cache_key, self._ttl, Metadata._revalidate)
         self._metadata_ts: datetime = ts
         self._metadata: Dict[Domain, SiteMetadata] = val or {}
 
+    @staticmethod
+    def _revalidate(state: SessionState) -> None:
+        Metadata(state).refresh()
+
     def __getitem__(self, domain: Domain) -> SiteMetadata:
         try:
             return self._metadata[domain]
@@ -33,5 +38,7 @@ class Metadata:
         self._save()
 
     def _save(self):
-        self._metadata_ts = datetime.utcnow()
-        self._state.save_obj(self._cache_key, (self._metadata_ts, self._metadata))
+        self._metadata_ts = self._state.save_timed(self._cache_key, self._metadata)
+
+
+key_family(Metadata._cache_key)
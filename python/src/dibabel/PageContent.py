@@ -1,9 +1,12 @@
+from dataclasses import dataclass
 from sys import intern
 from typing import Tuple, Union, Optional, List
 
+from .Codec import serializable
 from .DataTypes import Domain, Title, RevID
 
 
+@serializable('PageContent')
 class PageContent:
     def __init__(self, domain: Domain, title: Title, revid: RevID, content: str, content_ts: str,
                  protection: Optional[List[str]]):
@@ -19,3 +22,20 @@ class PageContent:
 
 
 TitlePagePair = Tuple[str, Union[PageContent, None]]
+
+
+@dataclass
+class PageHash:
+    """
+    Latest revision of a page without its content, only with the SHA1 of the content
+    """
+    revid: RevID
+    sha1: Optional[str]  # None if the revision is hidden
+    content_ts: str
+    protection: Optional[List[str]]
+
+    def to_content(self, domain: Domain, title: Title, content: str) -> PageContent:
+        return PageContent(domain, title, self.revid, content, self.content_ts, self.protection)
+
+
+TitleHashPair = Tuple[str, Union[PageHash, None]]
@@ -1,35 +1,32 @@
 import re
+from array import array
 from datetime import datetime
 from sys import intern
-from typing import List
-from typing import Optional, Callable
+from typing import List, Dict, Iterable
+from typing import Optional
 from typing import Set
 
+from .Codec import serializable
 from .DataTypes import RevComment, SyncInfo, QID, Title, Domain, RevID
 from .DataTypes import SiteMetadata
+from .LocalizationCache import LocalizationCache, DependencyMapping, digest_size
 from .PageContent import PageContent
+from .RevisionHistory import RevisionHistory
+from .Schema import key_family
 from .SessionState import SessionState
 from .Sitelinks import Sitelinks
 from .utils import calc_hash
 
-# Find any string that is a template name
-# Must be preceded by two {{ (not 3!), must be followed by either "|" or "}", must not include any funky characters
-reTemplateName = re.compile(r'''((?:^|[^{]){{\s*)([^|{}<>&#:]*[^|{}<>&#: ])(\s*[|}])''')
+# Find any string that is a template name, optionally with a namespace prefix
+# Must be preceded by two {{ (not 3!), must be followed by either "|" or "}", must not include any funky characters.
+# The "|" or "}" is not consumed, so that a template call directly inside the parameters is also found.
+reTemplateName = re.compile(r'''((?:^|[^{]){{\s*)((?:[^|{}<>&#:]*:)?[^|{}<>&#:]*[^|{}<>&#: ])(?=\s*[|}])''')
 
 # Find any require('Module:name') and mw.loadData('Module:name')
 # must be preceded by a space or an operation like = or a comma.
 reModuleName = re.compile(r'''((?:^|\s|=|,|\()(?:require|mw\.loadData)\s*\(\s*)('[^']+'|"[^"]+")(\s*\))''')
 
 
-def to_template(name):
-    if name.startswith('Template:'):
-        return name
-    elif name.startswith('template:'):
-        return 'T' + name[1:]
-    else:
-        return 'Template:' + name
-
-
 well_known_lua_modules = {
     'libraryUtil'
 }
@@ -39,77 +36,87 @@ def ignore_modules(name: str):
     return name in well_known_lua_modules
 
 
-def replace_module_deps(content: str,
-                        target_domain: Domain,
-                        title_sitelinks: Sitelinks,
-                        ignore: Callable[[Title], bool],
-                        ) -> str:
-    def sub_module(m):
-        name = m.group(2)
-        fullname = name[1:-1]  # strip first and last quote symbol
+def localize_module_name(name: str, localized: Title) -> str:
+    fullname = name[1:-1]  # strip first and last quote symbol
 
-        if ignore(fullname):
-            return m.group(0)
+    # The "Module:" namespace should stay unlocalized in modules per user request.
+    # The domain_to_title will still be localized because it might be used in templates(?).
+    # Keeping the namespace as it was written originally (first letter casing).
+    repl = fullname.split(':', 1)[0] + ':' + localized.split(':', 1)[1]
 
-        obj = title_sitelinks[fullname]
-        try:
-            repl = obj.domain_to_title[target_domain]
-        except KeyError:
-            return m.group(0)
+    quote = name[0]
+    if quote not in repl:
+        return quote + repl + quote
+    quote = '"' if quote == "'" else "'"
+    if quote not in repl:
+        return quote + repl + quote
+    return "'" + repl.replace("'", "\\'") + "'"
 
-        # The "Module:" namespace should stay unlocalized in modules per user request.
-        # The domain_to_title will still be localized because it might be used in templates(?).
-        # Keeping the namespace as it was written originally (first letter casing).
-        repl = fullname.split(':', 1)[0] + ':' + repl.split(':', 1)[1]
 
-        quote = name[0]
-        if quote not in repl:
-            name = quote + repl + quote
-        else:
-            quote = '"' if quote == "'" else "'"
-            if quote not in repl:
-                name = quote + repl + quote
-            else:
-                name = "'" + repl.replace("'", "\\'") + "'"
+def localize_template_name(name: str, localized: Title) -> str:
+    localized = localized.split(':', maxsplit=1)[1]
+    if ':' in name:
+        # Keep the namespace as it was written originally
+        return name.split(':', maxsplit=1)[0].rstrip() + ':' + localized
+    return localized
 
-        return m.group(1) + name + m.group(3)
 
-    return reModuleName.sub(sub_module, content)
+# Identifies the parsing rules, so that the dependencies stored with the history get re-parsed when the rules change
+parser_version = calc_hash('\n'.join([reTemplateName.pattern, reModuleName.pattern, *sorted(well_known_lua_modules)]))
 
 
-def replace_template_deps(content: str,
-                          target_domain: Domain,
-                          title_sitelinks: Sitelinks,
-                          ignore: Callable[[Title], bool],
-                          ) -> str:
-    def sub_template(m):
-        name = m.group(2)
-        if ignore(name):
-            return m.group(0)
-        obj = title_sitelinks[to_template(name)]
-        try:
-            name = obj.domain_to_title[target_domain].split(':', maxsplit=1)[1]
-        except KeyError:
-            return m.group(0)
+def get_parser_version(metadata: SiteMetadata) -> str:
+    # Parsing also depends on the magic words and namespace names of the primary site
+    return calc_hash(parser_version + metadata.matcher.pattern)
 
-        return m.group(1) + name + m.group(3)
 
-    return reTemplateName.sub(sub_template, content)
+# Dependencies found in the revision content, as a flat array of (start, end, dependency index) triples,
+# where the index points into the page's dependency_titles. The content between the slots is copied as is
+# during localization.
+DependencySlots = array
 
 
+@serializable('Primary')
 class Primary:
     _cache_prefix = 'history:'
+    _localized_prefix = 'localized:'
 
     def __init__(self, qid: QID, title: Title):
         self.qid = qid
         self.title = title
         self.is_module = self.title.startswith('Module:')
-        self.history: Optional[List[RevComment]] = None
+        self.history: Optional[RevisionHistory] = None
         # Dependencies found in the entire history of this page, non-normalized
         self.historic_dependencies: Optional[Set[Title]] = None
+        # Dependencies of each revision in history, non-normalized. Revisions with the same dependencies share the set.
+        self.revision_dependencies: Optional[Dict[RevID, Set[Title]]] = None
+        # Every dependency title found in the history, interned, in the order they were found
+        self.dependency_titles: Optional[List[Title]] = None
+        self._dependency_ids: Dict[Title, int] = {}
+        # Revision ID -> position in history. The dependency slots of each revision, parsed once when it was added,
+        # are stored in history.
+        self._positions: Dict[RevID, int] = {}
+        # Hash of each revision's content without trailing whitespace, in the same order as history
+        self.content_hashes: Optional[List[str]] = None
+        # Content hash -> position of the most recent revision with that content in history
+        self.content_index: Optional[Dict[str, int]] = None
         # Dependencies found in the most recent page version
         self.dependencies: Optional[Set[Title]] = None
         self.last_rev_id: Optional[RevID] = None
+        # Localized content of the historic revisions, and the stored hashes of its localization groups
+        self.localized: Optional[LocalizationCache] = None
+        # Mapping of historic dependencies -> localized content hash -> position in history.
+        # All domains with the same mapping of historic dependencies share the same localized content.
+        self._localized_indexes: Dict[DependencyMapping, Dict[str, int]] = {}
+
+    def __getstate__(self):
+        # The primaries index only keeps the lightweight metadata, history is stored and loaded separately
+        return dict(qid=self.qid, title=self.title, last_rev_id=self.last_rev_id, dependencies=self.dependencies)
+
+    def __setstate__(self, state):
+        self.__init__(state['qid'], state['title'])
+        self.last_rev_id = state['last_rev_id']
+        self.dependencies = state['dependencies']
 
     def __str__(self) -> str:
         return f"{self.title}"
@@ -118,28 +125,84 @@ class Primary:
     def last_revision(self) -> RevComment:
         return self.history[-1]
 
-    def set_history(self, history: List[RevComment], metadata: SiteMetadata) -> None:
-        self.history = []
+    def set_history(self, history: Iterable[RevComment], metadata: SiteMetadata) -> None:
+        self.history = RevisionHistory()
         self.historic_dependencies = set()
+        self.revision_dependencies = {}
+        self.dependency_titles = []
+        self._dependency_ids = {}
+        self._positions = {}
+        self.content_hashes = []
+        self.content_index = {}
         self.add_to_history(history, metadata)
 
-    def add_to_history(self, history: List[RevComment], metadata: SiteMetadata) -> None:
+    def add_to_history(self, history: Iterable[RevComment], metadata: SiteMetadata) -> None:
         # assume history is going from oldest to newest
         # assume the data is already de-duplicated
+        prev_deps = self.dependencies if self.history else None
         deps = None
         for rev in history:
-            self.history.append(rev)
-            deps = self.parse_dependencies(rev.content, metadata)
+            slots = self.parse_slots(rev.content, metadata)
+            self._positions[rev.revid] = len(self.history)
+            self.history.append(rev, slots)
+            deps = {self.dependency_titles[idx] for idx in slots[2::3]}
+            if deps == prev_deps:
+                deps = prev_deps
+            prev_deps = deps
+            self.revision_dependencies[rev.revid] = deps
             self.historic_dependencies.update(deps)
+            content_hash = calc_hash(rev.content.rstrip())
+            self.content_index[content_hash] = len(self.content_hashes)
+            self.content_hashes.append(content_hash)
         if deps is not None:
             self.dependencies = deps
+            self._localized_indexes.clear()
 
     def load_history(self, state: SessionState, metadata: SiteMetadata) -> None:
+        parsed = False
         if not self.history:
-            self.set_history(state.load_obj(f"{self._cache_prefix}{self.title}") or [], metadata)
-
-    def save_history(self, state: SessionState) -> None:
-        state.save_obj(f"{self._cache_prefix}{self.title}", self.history)
+            cached = state.load_obj(f"{self._cache_prefix}{self.title}")
+            if cached is None:
+                self.set_history([], metadata)
+                parsed = True
+            elif cached['parser_version'] != get_parser_version(metadata):
+                # Parsing rules have changed since the history was saved
+                self.set_history(cached['history'], metadata)
+                parsed = True
+            else:
+                self.history = cached['history']
+                self.dependency_titles = [intern(v) for v in cached['dependency_titles']]
+                self._dependency_ids = {v: idx for idx, v in enumerate(self.dependency_titles)}
+                self._positions = {rev.revid: idx for idx, rev in enumerate(self.history)}
+                self.revision_dependencies = self._shared_sets(cached['revision_dependencies'])
+                self.historic_dependencies = set(self.dependency_titles)
+                self.content_hashes = cached['content_hashes']
+                self.content_index = {v: idx for idx, v in enumerate(self.content_hashes)}
+                if self.history:
+                    self.dependencies = self.revision_dependencies[self.last_revision.revid]
+                self._localized_indexes.clear()
+        if self.localized is None:
+            # The stored object may be shared with other sessions through the memory cache,
+            # so the content is localized into a copy of it
+            stored = state.load_obj(f"{self._localized_prefix}{self.title}")
+            self.localized = stored.copy() if stored is not None else LocalizationCache()
+        if parsed:
+            # The stored hashes were computed from the previous parse
+            self.localized.clear_hashes()
+
+    def save_history(self, state: SessionState, metadata: SiteMetadata) -> None:
+        state.save_obj(f"{self._cache_prefix}{self.title}", dict(
+            parser_version=get_parser_version(metadata),
+            history=self.history,
+            dependency_titles=self.dependency_titles,
+            revision_dependencies=self.revision_dependencies,
+            content_hashes=self.content_hashes,
+        ))
+
+    def save_localized(self, state: SessionState) -> None:
+        if self.localized is not None and self.localized.modified:
+            self.localized.modified = False
+            state.save_obj(f"{self._localized_prefix}{self.title}", self.localized)
 
     def compute_sync_info(self, qid: QID, page: PageContent, metadata: SiteMetadata,
                           title_sitelinks: Sitelinks) -> SyncInfo:
@@ -150,7 +213,6 @@ class Primary:
         """
         assert self.history
 
-        changes = []
         current_content = page.content.rstrip()
         result = SyncInfo('',
                           qid,
@@ -160,53 +222,185 @@ class Primary:
                           dst_timestamp=page.content_ts,
                           dst_protection=page.protection)
 
-        for hist in reversed(self.history):
-            adj = self.localize_content(hist.content, metadata, page.domain, title_sitelinks)
-
-            if result.new_content is None:
-                # Comparing current revision of the primary page
-                result.new_content = intern(adj)
-                result.dst_revid = hist.revid
-                # Latest revision must match adjusted content
-                if adj.rstrip() == current_content:
-                    # Latest matches what we expect - nothing to do, stop
-                    result.hash = calc_hash(hist.content)
-                    result.status = 'ok'
-                    break
-                elif hist.content.rstrip() == current_content:
-                    # local template was renamed without any changes in primary
-                    # the hash is the same as for 'ok'
-                    result.hash = calc_hash(hist.content)
-                    result.status = 'unlocalized'
-                    break
-            elif adj.rstrip() == current_content or hist.content.rstrip() == current_content:
+        # Comparing current revision of the primary page
+        last_rev = self.last_revision
+        adj = self.localize_revision(last_rev, metadata, page.domain, title_sitelinks)
+        result.new_content = intern(adj)
+        result.dst_revid = last_rev.revid
+
+        # Latest revision must match adjusted content
+        if adj.rstrip() == current_content:
+            # Latest matches what we expect - nothing to do
+            result.hash = calc_hash(last_rev.content)
+            result.status = 'ok'
+        else:
+            # Find the most recent revision whose content, either original or localized, matches the target
+            current_hash = calc_hash(current_content)
+            localized_index = self._get_localized_index(metadata, page.domain, title_sitelinks)
+            position = max(self.content_index.get(current_hash, -1), localized_index.get(current_hash, -1))
+            last_position = len(self.history) - 1
+            if position == last_position:
+                # local template was renamed without any changes in primary
+                # the hash is the same as for 'ok'
+                result.hash = calc_hash(last_rev.content)
+                result.status = 'unlocalized'
+            elif position >= 0:
                 # One of the previous revisions matches current state of the target
+                hist = self.history[position]
                 result.matched_revid = hist.revid
-                result.behind = len(changes)
+                result.behind = last_position - position
                 result.hash = calc_hash(hist.content)
                 result.status = 'outdated'
-                break
-            changes.append(hist)
-        else:
-            # Diverged content: current target content was not found in primary's history
-            result.hash = calc_hash(current_content)
-            result.status = 'diverged'
+            else:
+                # Diverged content: current target content was not found in primary's history
+                result.hash = calc_hash(current_content)
+                result.status = 'diverged'
 
         assert result.status != ''
         return result
 
-    def parse_dependencies(self, content, metadata: SiteMetadata) -> Set[Title]:
+    def parse_slots(self, content: str, metadata: SiteMetadata) -> DependencySlots:
+        slots = array('i')
         if self.is_module:
-            # strip first and last quote symbol
-            return set(v for v in (vv[1][1:-1] for vv in reModuleName.findall(content))
-                       if not ignore_modules(v))
+            for m in reModuleName.finditer(content):
+                name = m.group(2)[1:-1]  # strip first and last quote symbol
+                if not ignore_modules(name):
+                    slots.extend((m.start(2), m.end(2), self._dependency_id(metadata.module_name(name))))
         else:
-            return set(to_template(v[1]) for v in reTemplateName.findall(content)
-                       if not metadata.is_magic_keyword(v[1]))
+            for m in reTemplateName.finditer(content):
+                name = metadata.template_name(m.group(2))
+                if name is not None:
+                    slots.extend((m.start(2), m.end(2), self._dependency_id(name)))
+        return slots
 
-    def localize_content(self, content, metadata: SiteMetadata, target_domain: Domain,
-                         title_sitelinks: Sitelinks) -> str:
-        if self.is_module:
-            return replace_module_deps(content, target_domain, title_sitelinks, ignore_modules)
-        else:
-            return replace_template_deps(content, target_domain, title_sitelinks, metadata.is_magic_keyword)
+    def _dependency_id(self, title: Title) -> int:
+        try:
+            return self._dependency_ids[title]
+        except KeyError:
+            title = intern(title)
+            self._dependency_ids[title] = len(self.dependency_titles)
+            self.dependency_titles.append(title)
+            return self._dependency_ids[title]
+
+    @staticmethod
+    def _shared_sets(revision_dependencies: Dict[RevID, Set[Title]]) -> Dict[RevID, Set[Title]]:
+        # Most revisions have the same dependencies as the previous one, so they share a single set
+        result = {}
+        prev = None
+        for revid, deps in revision_dependencies.items():
+            if deps != prev:
+                prev = {intern(v) for v in deps}
+            result[revid] = prev
+        return result
+
+    def dependency_mapping(self, dependencies: Iterable[Title], metadata: SiteMetadata, target_domain: Domain,
+                           title_sitelinks: Sitelinks) -> DependencyMapping:
+        mapping = []
+        for dep in sorted(dependencies):
+            if not self.is_module and metadata.is_magic_keyword(dep.split(':', 1)[1]):
+                continue
+            try:
+                mapping.append((dep, title_sitelinks[dep].domain_to_title[target_domain]))
+            except KeyError:
+                pass
+        return tuple(mapping)
+
+    def localize_revision(self, rev: RevComment, metadata: SiteMetadata, target_domain: Domain,
+                          title_sitelinks: Sitelinks) -> str:
+        mapping = self.dependency_mapping(
+            self.revision_dependencies[rev.revid], metadata, target_domain, title_sitelinks)
+        if not mapping:
+            # None of the dependencies have a copy in the target domain
+            return rev.content
+        content = self.localized.get(rev.revid, mapping)
+        if content is None:
+            content = self.localize_content(rev.content, self.history.slots(self._positions[rev.revid]), mapping)
+            self.localized.put(rev.revid, mapping, content)
+        return content
+
+    def localization_group(self, metadata: SiteMetadata, target_domain: Domain,
+                           title_sitelinks: Sitelinks) -> DependencyMapping:
+        """
+        Domains with the same localization group get identical localized content for every revision
+        """
+        return self.dependency_mapping(self.historic_dependencies, metadata, target_domain, title_sitelinks)
+
+    def _get_localized_index(self, metadata: SiteMetadata, target_domain: Domain,
+                             title_sitelinks: Sitelinks) -> Dict[str, int]:
+        group = self.localization_group(metadata, target_domain, title_sitelinks)
+        if not group:
+            # Nothing is localized in this domain
+            return self.content_index
+        try:
+            return self._localized_indexes[group]
+        except KeyError:
+            pass
+        hashes = self.localized.get_hashes(group)
+        count = len(hashes) // digest_size
+        if count > len(self.history):
+            # Stored for a longer history, e.g. before it was loaded again from scratch
+            hashes, count = b'', 0
+        index = {hashes[position * digest_size:(position + 1) * digest_size].hex(): position
+                 for position in range(count)}
+        if count < len(self.history):
+            # Only the revisions added since the hashes were stored are localized, without keeping their content
+            hashes = bytearray(hashes)
+            for position in range(count, len(self.history)):
+                rev = self.history[position]
+                mapping = self.dependency_mapping(
+                    self.revision_dependencies[rev.revid], metadata, target_domain, title_sitelinks)
+                if mapping:
+                    content_hash = calc_hash(self.localize_content(
+                        rev.content, self.history.slots(position), mapping).rstrip())
+                else:
+                    content_hash = self.content_hashes[position]
+                index[content_hash] = position
+                hashes += bytes.fromhex(content_hash)
+            self.localized.set_hashes(group, bytes(hashes))
+        self._localized_indexes[group] = index
+        return index
+
+    def known_hashes(self, metadata: SiteMetadata, target_domain: Domain,
+                     title_sitelinks: Sitelinks) -> Set[str]:
+        """
+        Hashes of the content of every historic revision in the target domain, both original and localized,
+        to recognize a copy of any of them without downloading its content
+        """
+        localized_index = self._get_localized_index(metadata, target_domain, title_sitelinks)
+        return set(self.content_index).union(localized_index)
+
+    def content_by_hash(self, content_hash: str, metadata: SiteMetadata, target_domain: Domain,
+                        title_sitelinks: Sitelinks) -> Optional[str]:
+        """
+        The content in the target domain with the given hash, as returned by known_hashes(), without trailing whitespace
+        """
+        localized_index = self._get_localized_index(metadata, target_domain, title_sitelinks)
+        position = max(self.content_index.get(content_hash, -1), localized_index.get(content_hash, -1))
+        if position < 0:
+            return None
+        rev = self.history[position]
+        content = rev.content.rstrip()
+        if calc_hash(content) != content_hash:
+            content = self.localize_revision(rev, metadata, target_domain, title_sitelinks).rstrip()
+        return content
+
+    def localize_content(self, content: str, slots: DependencySlots, mapping: DependencyMapping) -> str:
+        localize_name = localize_module_name if self.is_module else localize_template_name
+        localized = dict(mapping)
+        parts = []
+        pos = 0
+        for idx in range(0, len(slots), 3):
+            start, end, dep = slots[idx], slots[idx + 1], self.dependency_titles[slots[idx + 2]]
+            try:
+                repl = localized[dep]
+            except KeyError:
+                continue
+            parts.append(content[pos:start])
+            parts.append(localize_name(content[start:end], repl))
+            pos = end
+        parts.append(content[pos:])
+        return ''.join(parts)
+
+
+key_family(Primary._cache_prefix)
+key_family(Primary._localized_prefix)
@@ -1,17 +1,31 @@
 from datetime import datetime, timedelta
-from typing import Dict, List, Iterable, Tuple
+from functools import partial
+from typing import Dict, List, Iterable, Tuple, Set
 
+from pywikiapi import AttrDict
+
+from .ChangeFeed import ChangeFeed
 from .DataTypes import WdWarning, QID, WdSitelink, Title
+from .FetchPool import FetchPool
 from .Metadata import Metadata
 from .Primary import Primary
+from .Schema import key_family
 from .SessionState import SessionState
+from .SitelinkSource import ApiSitelinkSource, WdItem, multi_site_class
 from .Sitelinks import Sitelinks
-from .utils import parse_wd_sitelink, primary_domain, parse_qid, is_older_than
+from .utils import primary_domain, wikidata_domain
 
 
 class PrimaryPages:
     _cache_key = 'primaries_by_qid'
     _ttl = timedelta(minutes=3)
+    # Number of concurrent requests to download the content of new revisions
+    _history_fetches = 4
+    # Number of new revisions after which a partially loaded history is saved
+    _history_checkpoint = 1000
+    # The list of primaries is updated from the Wikidata changes, and queried in full once in a while,
+    # in case some change was missed
+    _reconcile_interval = timedelta(hours=1)
 
     def __init__(self, state: SessionState, metadata: Metadata, sitelinks: Sitelinks, warnings: List[WdWarning]):
         self._state = state
@@ -19,69 +33,127 @@ class PrimaryPages:
         self._sitelinks = sitelinks
         self._warnings: List[WdWarning] = warnings
 
-        ts, val = state.load_obj(self._cache_key, (None, None))
+        # User requests use the stale list while it is being refreshed in the background
+        val, ts, expired = state.load_timed(self._cache_key, self._ttl, PrimaryPages._revalidate)
         self._primary_pages_by_qid_ts: datetime = ts
         self._primaries_by_qid: Dict[QID, Primary] = val or {}
 
         # Update reverse lookup by title
         self._primaries_by_title: Dict[Title, Primary] = {v.title: v for v in self._primaries_by_qid.values()}
-
-        if is_older_than(self._primary_pages_by_qid_ts, self._ttl):
-            primary_metadata = self._metadata[primary_domain]
-
+        # Copies of the primaries with their history loaded, for this session only
+        self._loaded: Dict[QID, Primary] = {}
+
+        if expired:
+            self._refresh()
+
+    @staticmethod
+    def _revalidate(state: SessionState) -> None:
+        metadata = Metadata(state)
+        PrimaryPages(state, metadata, Sitelinks(state, []), [])
+
+    def _refresh(self):
+        primary_metadata = self._metadata[primary_domain]
+
+        # Only the Wikidata items that have changed since the previous refresh need to be checked
+        # All primaries are queried again when reconciling, so the changes are not needed then
+        wd_changes = ChangeFeed(self._state, 'wikidata', namespaces=[0], reconcile_interval=self._reconcile_interval,
+                                rc_filter=partial(self._is_relevant_change, set(self._primaries_by_qid)),
+                                reconcile_titles=False)
+        wd_change = wd_changes.poll([self._state.get_site(wikidata_domain)])[wikidata_domain]
+        if wd_change.verify_all:
             new_primaries = self._query_primaries()
-            # Remove primary pages that are no longer listed as multi-copiable in WD
-            for old_key in set(self._primaries_by_qid.keys()).difference(new_primaries.keys()):
-                primary = self._primaries_by_qid.pop(old_key)
-                del self._primaries_by_title[primary.title]
-
-            # Create new primary pages
-            for qid, sl in new_primaries.items():
-                if qid not in self._primaries_by_qid:
-                    primary = Primary(qid, sl.title)
-                    primary.load_history(state, primary_metadata)
-                    self._primaries_by_qid[qid] = primary
-                    self._primaries_by_title[primary.title] = primary
-
-            # Find latest available revisions for primary pages, and cleanup if does not exist
-            primaries_to_load: List[Primary] = []
-            for title, revid in self._state.primary_site.query_pages_revid(
-                    (v.title for v in self._primaries_by_qid.values())):
-                if revid == 0:
-                    primary = self._primaries_by_title.pop(title)
-                    del self._primaries_by_qid[primary.qid]
-                else:
-                    primary = self._primaries_by_title[title]
-                    if primary.last_rev_id != revid:
-                        primary.last_rev_id = revid
-                        primaries_to_load.append(primary)
-
-            if primaries_to_load:
-                # These primary pages have been modified, load new revisions
+            changed_items = []
+        else:
+            new_primaries = {qid: WdSitelink(qid, primary_domain, v.title) for qid, v in self._primaries_by_qid.items()}
+            changed_items = self._apply_item_changes(wd_change.titles, new_primaries)
+
+        # Remove primary pages that are no longer listed as multi-copiable in WD
+        for old_key in set(self._primaries_by_qid.keys()).difference(new_primaries.keys()):
+            primary = self._primaries_by_qid.pop(old_key)
+            del self._primaries_by_title[primary.title]
+
+        # Create new primary pages, and replace the ones whose item now links to a different page
+        for qid, sl in new_primaries.items():
+            if qid in self._primaries_by_qid and self._primaries_by_qid[qid].title != sl.title:
+                del self._primaries_by_title[self._primaries_by_qid.pop(qid).title]
+            if qid not in self._primaries_by_qid:
+                primary = Primary(qid, sl.title)
+                primary.load_history(self._state, primary_metadata)
+                self._primaries_by_qid[qid] = primary
+                self._primaries_by_title[primary.title] = primary
+
+        # Only the primary pages that have changed since the previous refresh, and the new ones, need to be checked
+        changes = ChangeFeed(self._state, 'primaries', reconcile_titles=False)
+        change = changes.poll([self._state.primary_site])[primary_domain]
+        if change.verify_all:
+            titles = [v.title for v in self._primaries_by_qid.values()]
+        else:
+            titles = [v.title for v in self._primaries_by_qid.values()
+                      if v.last_rev_id is None or v.title in change.titles]
+
+        # Find latest available revisions for primary pages, and cleanup if does not exist
+        primaries_to_load: List[Primary] = []
+        for title, revid in (self._state.primary_site.query_pages_revid(titles) if titles else []):
+            if revid == 0:
+                primary = self._primaries_by_title.pop(title)
+                del self._primaries_by_qid[primary.qid]
+            else:
+                primary = self._primaries_by_title[title]
+                if primary.last_rev_id != revid:
+                    primary.last_rev_id = revid
+                    primaries_to_load.append(primary)
+
+        if primaries_to_load:
+            # These primary pages have been modified, load new revisions
+            with FetchPool(self._history_fetches, self._history_fetches) as pool:
                 for primary in primaries_to_load:
-                    primary.load_history(self._state, primary_metadata)
-                    hist = self._state.primary_site.load_page_history(primary.title, primary.history)
-                    if hist:
-                        primary.add_to_history(hist, primary_metadata)
-                        primary.save_history(self._state)
-
-                # Load sitelinks for both primary pages and their dependencies
-                titles = set((v.title for v in primaries_to_load))
-                for primary in primaries_to_load:
-                    titles.update(primary.historic_dependencies)
-                self._sitelinks.refresh(titles)
-
-                self._save()
+                    self._load_new_revisions(primary, pool)
+
+            # Load sitelinks for both primary pages and their dependencies
+            titles = set((v.title for v in primaries_to_load))
+            for primary in primaries_to_load:
+                titles.update(primary.historic_dependencies)
+            self._sitelinks.refresh(titles)
+
+        # The changed items were just loaded from the Wikidata API, which may be ahead of the sitelink source
+        if changed_items:
+            self._sitelinks.update_items(changed_items)
+
+        # Saved even if nothing has changed, to restart the TTL
+        self._save()
+        changes.commit()
+        wd_changes.commit()
+
+    def _load_new_revisions(self, primary: Primary, pool: FetchPool) -> None:
+        primary_metadata = self._metadata[primary_domain]
+        primary.load_history(self._state, primary_metadata)
+        unsaved = 0
+        for revisions in self._state.primary_site.load_page_history(primary.title, primary.history, pool):
+            primary.add_to_history(revisions, primary_metadata)
+            unsaved += len(revisions)
+            if unsaved >= self._history_checkpoint:
+                # Long histories are saved as they are loaded, so that an interrupted load continues from here
+                primary.save_history(self._state, primary_metadata)
+                self._state.flush()
+                unsaved = 0
+        if unsaved:
+            primary.save_history(self._state, primary_metadata)
 
     def _save(self):
-        self._primary_pages_by_qid_ts = datetime.utcnow()
-        self._state.save_obj(self._cache_key, (self._primary_pages_by_qid_ts, self._primaries_by_qid))
+        self._primary_pages_by_qid_ts = self._state.save_timed(self._cache_key, self._primaries_by_qid)
 
     def get_page(self, qid: QID, load_history=False) -> Primary:
         primary = self._primaries_by_qid[qid]
-        if load_history:
-            primary.load_history(self._state, self._metadata[primary_domain])
-        return primary
+        if not load_history or primary.history:
+            return primary
+        if qid not in self._loaded:
+            # The index objects may be shared with other sessions through the memory cache,
+            # so the history is loaded into a copy instead of growing the shared object
+            loaded = Primary.__new__(Primary)
+            loaded.__setstate__(primary.__getstate__())
+            loaded.load_history(self._state, self._metadata[primary_domain])
+            self._loaded[qid] = loaded
+        return self._loaded[qid]
 
     def get_all_qids(self) -> Iterable[QID]:
         return self._primaries_by_qid.keys()
@@ -90,14 +162,33 @@ class PrimaryPages:
         return self._primaries_by_qid.items()
 
     def _query_primaries(self) -> Dict[QID, WdSitelink]:
-        query = '''\
-SELECT ?id ?sl WHERE {
-  ?id wdt:P31 wd:Q63090714.
-  ?sl schema:about ?id;
-      schema:isPartOf <https://%%%/>.
-}'''.replace('%%%', primary_domain)
-        return {v.qid: v
-                for v in [
-                    parse_wd_sitelink(parse_qid(row), row['sl']['value'], self._warnings)
-                    for row in self._state.wikidata.query(query)]
-                if v}
+        return {v.qid: v for v in self._state.sitelink_source.query_primaries(self._warnings)}
+
+    @staticmethod
+    def _is_relevant_change(tracked: Set[QID], rc: AttrDict) -> bool:
+        # Runs in a pool thread. Edits of other items only matter if they could have added the primaries class,
+        # which is mentioned in the automatic summary of the statement edits.
+        return rc.title in tracked or multi_site_class in rc.get('comment', '')
+
+    def _apply_item_changes(self, qids: Set[QID], primaries: Dict[QID, WdSitelink]) -> List[WdItem]:
+        """
+        Update the primaries with the current state of the changed items, and return the items that still exist.
+        The items are loaded from the Wikidata API even if WDQS is the sitelink source, because WDQS may lag behind.
+        """
+        if not qids:
+            return []
+        items = list(ApiSitelinkSource(self._state.get_site(wikidata_domain)).query_entities(qids))
+        by_qid = {v.qid: v for v in items}
+        for qid in qids:
+            item = by_qid.get(qid)
+            sitelink = None
+            if item is not None and multi_site_class in item.classes:
+                sitelink = next((v for v in item.sitelinks if v.domain == primary_domain), None)
+            if sitelink is not None:
+                primaries[qid] = sitelink
+            else:
+                primaries.pop(qid, None)
+        return items
+
+
+key_family(PrimaryPages._cache_key)
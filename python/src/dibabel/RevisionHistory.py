@@ -0,0 +1,172 @@
+import marshal
+import zlib
+from array import array
+from difflib import SequenceMatcher
+from typing import List, Tuple, Optional, Union, Iterator
+
+from .Codec import serializable
+from .DataTypes import RevComment, RevID, Timestamp
+
+# Line-based delta: (start, end) copies lines from the previous revision, a string inserts new text
+Delta = List[Union[Tuple[int, int], str]]
+
+
+def make_delta(old_lines: List[str], new_lines: List[str]) -> Delta:
+    delta = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_lines, new_lines).get_opcodes():
+        if tag == 'equal':
+            delta.append((i1, i2))
+        elif j1 < j2:
+            delta.append(''.join(new_lines[j1:j2]))
+    return delta
+
+
+def encode_slots(slots: array) -> bytes:
+    # Slots are (start, end, value) triples in the order of start. Storing the gaps between them instead of
+    # the positions makes similar revisions produce similar bytes, which compress well.
+    gaps = array('i', slots)
+    for idx in range(len(gaps) - 3, 0, -3):
+        gaps[idx + 1] -= gaps[idx]
+        gaps[idx] -= gaps[idx - 2]
+    if gaps:
+        gaps[1] -= gaps[0]
+    return zlib.compress(gaps.tobytes())
+
+
+def decode_slots(data: bytes) -> array:
+    slots = array('i')
+    slots.frombytes(zlib.decompress(data))
+    for idx in range(0, len(slots), 3):
+        if idx:
+            slots[idx] += slots[idx - 2]
+        slots[idx + 1] += slots[idx]
+    return slots
+
+
+def apply_delta(old_lines: List[str], delta: Delta) -> List[str]:
+    lines = []
+    for op in delta:
+        if isinstance(op, str):
+            lines.extend(op.splitlines(keepends=True))
+        else:
+            lines.extend(old_lines[op[0]:op[1]])
+    return lines
+
+
+class StoredRevComment(RevComment):
+    """
+    A revision whose content is materialized from the history store on access
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, history: 'RevisionHistory', index: int, user: str, ts: Timestamp, comment: str,
+                 revid: RevID):
+        self.user = user
+        self.ts = ts
+        self.comment = comment
+        self.revid = revid
+        self._history = history
+        self._index = index
+
+    @property
+    def content(self) -> str:
+        return self._history.content(self._index)
+
+
+@serializable('RevisionHistory')
+class RevisionHistory:
+    """
+    Page revisions from oldest to newest. Every Nth revision is stored as a compressed keyframe,
+    and all others as a compressed delta from the previous revision. The dependency slots parsed from
+    each revision's content are stored compressed next to it, and decoded on access as well.
+    Behaves as a read-only list of RevComment, plus the append() and slots() methods.
+    """
+
+    def __init__(self, keyframe_interval: int = 20):
+        self.keyframe_interval = keyframe_interval
+        # (user, timestamp, comment, revid) for each revision
+        self._revisions: List[Tuple[str, Timestamp, str, RevID]] = []
+        # Compressed content of keyframes, or of deltas for all other revisions
+        self._blobs: List[bytes] = []
+        # Compressed dependency slots of each revision
+        self._slots: List[bytes] = []
+        # Most recently decoded slots
+        self._recent_slots: Optional[Tuple[int, array]] = None
+        # Most recently materialized revision, used as a starting point for the next one
+        self._recent: Optional[Tuple[int, List[str]]] = None
+        # Content of the newest revision, which is needed far more often than the others
+        self._last: Optional[Tuple[List[str], str]] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_recent'] = None
+        state['_last'] = None
+        state['_recent_slots'] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self._revisions)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[RevComment, List[RevComment]]:
+        if isinstance(index, slice):
+            return [self._get(idx) for idx in range(*index.indices(len(self._revisions)))]
+        if index < 0:
+            index += len(self._revisions)
+        if not 0 <= index < len(self._revisions):
+            raise IndexError('revision index out of range')
+        return self._get(index)
+
+    def __iter__(self) -> Iterator[RevComment]:
+        return (self._get(idx) for idx in range(len(self._revisions)))
+
+    def __reversed__(self) -> Iterator[RevComment]:
+        return (self._get(idx) for idx in reversed(range(len(self._revisions))))
+
+    def append(self, rev: RevComment, slots: array = None) -> None:
+        index = len(self._revisions)
+        lines = rev.content.splitlines(keepends=True)
+        if index % self.keyframe_interval == 0:
+            data = rev.content
+        else:
+            data = make_delta(self._lines(index - 1), lines)
+        self._blobs.append(zlib.compress(marshal.dumps(data)))
+        self._slots.append(encode_slots(slots if slots is not None else array('i')))
+        self._revisions.append((rev.user, rev.ts, rev.comment, rev.revid))
+        self._last = (lines, rev.content)
+
+    def content(self, index: int) -> str:
+        if index == len(self._revisions) - 1:
+            return self._last_content()[1]
+        return ''.join(self._lines(index))
+
+    def slots(self, index: int) -> array:
+        """
+        Dependency slots of the revision at the given position, as they were given to append()
+        """
+        if self._recent_slots is None or self._recent_slots[0] != index:
+            self._recent_slots = (index, decode_slots(self._slots[index]))
+        return self._recent_slots[1]
+
+    def _get(self, index: int) -> StoredRevComment:
+        return StoredRevComment(self, index, *self._revisions[index])
+
+    def _last_content(self) -> Tuple[List[str], str]:
+        if self._last is None:
+            lines = self._lines(len(self._revisions) - 1)
+            self._last = (lines, ''.join(lines))
+        return self._last
+
+    def _lines(self, index: int) -> List[str]:
+        if self._last is not None and index == len(self._revisions) - 1:
+            return self._last[0]
+        keyframe = index - index % self.keyframe_interval
+        if self._recent is not None and keyframe <= self._recent[0] <= index:
+            position, lines = self._recent
+        else:
+            position = keyframe
+            lines = marshal.loads(zlib.decompress(self._blobs[keyframe])).splitlines(keepends=True)
+        while position < index:
+            position += 1
+            lines = apply_delta(lines, marshal.loads(zlib.decompress(self._blobs[position])))
+        self._recent = (index, lines)
+        return lines
@@ -0,0 +1,86 @@
+from typing import Any, Dict, Tuple, Callable, List, Optional
+
+from .Codec import SchemaError, OutdatedState
+
+# Key prefix -> current schema version of the values stored under it
+_versions: Dict[str, int] = {}
+# (key prefix, version) -> function that converts a value of that version to the next one
+_upgrades: Dict[Tuple[str, int], Callable[[Any], Any]] = {}
+
+# Stored values are prefixed with the header and the two-byte schema version of their key family.
+# Values without the header were stored before the versioning, and are treated as version 1.
+_header = b'S'
+
+
+def key_family(prefix: str, version: int = 1) -> None:
+    """
+    Declare the schema version of all values stored with the keys that start with the prefix.
+    Increment the version whenever the layout of the stored values changes, including the layout of the classes
+    they contain. Values stored with an older version are upgraded on load by the functions registered with @upgrade,
+    or treated as missing if there are none. Other key families are not affected.
+    """
+    if prefix in _versions and _versions[prefix] != version:
+        raise ValueError(f'Key family {prefix} is already declared with version {_versions[prefix]}')
+    _versions[prefix] = version
+
+
+def upgrade(prefix: str, from_version: int) -> Callable[[Callable[[Any], Any]], Callable[[Any], Any]]:
+    """
+    Decorator to register a function that converts a value of the given key family from one version to the next.
+    The objects whose class layout has changed since are given as OutdatedState, and must be restored by one of
+    the upgrade functions of the chain.
+    """
+
+    def register(func: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        _upgrades[(prefix, from_version)] = func
+        return func
+
+    return register
+
+
+def get_family(key: str) -> Tuple[str, int]:
+    """
+    Key prefix and current version of the key family of the given key. Keys of undeclared families use version 1.
+    """
+    result = ('', 1)
+    for prefix, version in _versions.items():
+        if key.startswith(prefix) and len(prefix) >= len(result[0]):
+            result = (prefix, version)
+    return result
+
+
+def add_version(key: str, data: bytes) -> bytes:
+    return _header + get_family(key)[1].to_bytes(2, 'big') + data
+
+
+def split_version(data: bytes) -> Tuple[int, bytes]:
+    if data[:1] != _header:
+        return 1, data
+    return int.from_bytes(data[1:3], 'big'), data[3:]
+
+
+def decode_value(key: str, data: bytes, decode: Callable[[bytes, Optional[List[OutdatedState]]], Any]) -> Any:
+    """
+    Decode a stored value with decode(data, outdated), and upgrade it to the current version of its key family.
+    Objects of an older class layout are only accepted in the values of an older key family version.
+    """
+    version, data = split_version(data)
+    outdated = [] if version < get_family(key)[1] else None
+    value = upgrade_value(key, version, decode(data, outdated))
+    if outdated and not all(v.restored for v in outdated):
+        tags = sorted({v.tag for v in outdated if not v.restored})
+        raise SchemaError(f'{key} has objects of an older layout that were not upgraded: {", ".join(tags)}')
+    return value
+
+
+def upgrade_value(key: str, version: int, value: Any) -> Any:
+    prefix, current = get_family(key)
+    if version > current:
+        raise SchemaError(f'{key} was stored with a newer schema version {version}, expected {current}')
+    while version < current:
+        try:
+            value = _upgrades[(prefix, version)](value)
+        except KeyError:
+            raise SchemaError(f'{key} was stored with schema version {version}, expected {current}')
+        version += 1
+    return value
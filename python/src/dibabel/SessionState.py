@@ -1,8 +1,11 @@
 import random
-from datetime import datetime
+import re
+import threading
+import traceback
+from datetime import datetime, timedelta
 from pathlib import Path
-from pickle import loads, dumps
-from typing import Any, Optional
+from typing import Any, Optional, Iterable, Dict, List, Tuple, Callable
+from uuid import uuid4
 
 from redis import Redis
 from requests.adapters import HTTPAdapter
@@ -10,47 +13,128 @@ from requests.packages.urllib3.util.retry import Retry
 from requests.sessions import Session
 from sqlitedict import SqliteDict
 
+from .Codec import CompactCodec, SchemaError
 from .DataTypes import Domain
+from .MemoryCache import MemoryCache
+from .Schema import add_version, decode_value
+from .SitelinkSource import WdqsSitelinkSource, ApiSitelinkSource
 from .Sparql import Sparql
 from .WikiSite import WikiSite
-from .utils import primary_domain
+from .utils import primary_domain, batches, wikidata_domain
 
 
-def create_session(user_requested: bool, redis="tools-redis.svc.eqiad.wmflabs"):
+# Marks a value that is not in the cache, or cannot be decoded
+_missing = object()
+
+# Decoded objects shared by all sessions of this process
+_memory_cache = MemoryCache()
+
+# Held while this process refreshes the state, either by the refresher or by a revalidation
+_refresh_lock = threading.Lock()
+
+# Delete or extend the Redis refresh lock, but only if it is still held with the given token
+_unlock_script = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+_renew_script = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end " \
+                "return 0"
+
+
+def _identity(value):
+    return value
+
+
+def _prefix_range(prefix: str) -> Tuple[str, List[str]]:
+    """
+    SQL condition and parameters to find all keys with the given prefix using the primary key index
+    """
+    if not prefix:
+        return 'key != ?', ['_cache_key_']
+    # The smallest string that is greater than all strings with this prefix
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return 'key >= ? AND key < ? AND key != ?', [prefix, end, '_cache_key_']
+
+
+def create_session(user_requested: bool, redis="tools-redis.svc.eqiad.wmflabs", sitelink_source='wdqs'):
     # Path to the cache file
     cache_file = Path('../cache/cache.sqlite')
-    # This should be changed every time database schema is changed
-    db_version = "eO14i1AM"
+    # Changing this discards the whole cache. When the layout of some stored values changes,
+    # increment the version of their key family instead (see Schema.key_family)
+    db_version = "Xq4sT9bE"
 
-    return SessionState(cache_file, db_version, redis, user_requested=user_requested)
+    # User requests only write a few values, and must not hold the SQLite write lock while the refresher waits for it
+    return SessionState(cache_file, db_version, redis, user_requested=user_requested, memory=_memory_cache,
+                        write_behind=not user_requested, sitelink_source=sitelink_source)
 
 
 class SessionState:
-    def __init__(self, cache_file: Path, cache_key: str, redis: str, user_requested=False):
+    # Stay below the SQLite limit on the number of query parameters
+    _sql_batch_size = 500
+    # In the write-behind mode, SQLite writes are committed once any of these is exceeded, or on flush().
+    # The interval stays well below the 5 seconds other connections wait for the write lock before failing.
+    _flush_max_items = 1000
+    _flush_max_bytes = 32 * 1024 * 1024
+    _flush_interval = timedelta(seconds=2)
+    # Another process may start refreshing after this time, in case this one has died.
+    # A running refresh renews it every third of this time.
+    _refresh_timeout = timedelta(minutes=2)
+
+    def __init__(self, cache_file: Path, cache_key: str, redis: str, user_requested=False, codec=None,
+                 memory: MemoryCache = None, write_behind=True, sitelink_source='wdqs'):
         self.user_requested = user_requested
+        # Commit SQLite writes in large transactions instead of after every write. Redis is still updated right away,
+        # so the uncommitted writes are only lost from the backing store if the process dies before flushing them.
+        self._write_behind = write_behind
+        self._pending_items = 0
+        self._pending_bytes = 0
+        # Commits the pending writes once the interval has passed, even if this session is waiting for the network
+        self._flush_timer: Optional[threading.Timer] = None
+        self._pending_lock = threading.Lock()
+        # Token of the refresh lock and the event that stops renewing it, while this session holds the lock
+        self._refresh_lock: Optional[Tuple[str, threading.Event]] = None
+        # Any object with encode(value) -> bytes and decode(bytes, outdated) -> value methods, see CompactCodec
+        self._codec = codec or CompactCodec()
         self._cache_file = cache_file
         self._cache_key = cache_key
         self._cache: Optional[SqliteDict] = None
         random.seed()
         self._session_key = random.randint(0, 999999)
+        self._redis_host = redis
         self._redis = Redis(host=redis)
+        # Objects are read from the in-process cache only by the user requests. The refresher modifies the objects
+        # it loads, so it always gets its own copy, but it still invalidates the cached objects it changes.
+        self._memory = memory
+        if memory is not None:
+            memory.subscribe(self._redis, self._cache_key + '|invalidate')
 
         if not user_requested:
             self._open()
-            if self._cache_key != self._cache.get("_cache_key_", None):
+            if self._cache_key != self._decode("_cache_key_", self._cache.get("_cache_key_", None)):
                 self._cache.close()
                 self._cache: Optional[SqliteDict] = None
-                self._cache_file.unlink()
+                for file in (self._cache_file, self._cache_file.with_name(self._cache_file.name + '-wal'),
+                             self._cache_file.with_name(self._cache_file.name + '-shm')):
+                    if file.exists():
+                        file.unlink()
                 self._open()
-                self._cache["_cache_key_"] = self._cache_key
+                self._cache["_cache_key_"] = self._encode("_cache_key_", self._cache_key)
+                self._cache.commit()
 
         self.session = Session()
+        # Keep the connections to many wikis open, as they are queried concurrently
         # noinspection PyTypeChecker
         self.session.mount(
             'https://',
-            HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])))
+            HTTPAdapter(pool_connections=100,
+                        max_retries=Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])))
         self.sites = {}
-        self.wikidata = Sparql()
+        self.wikidata = Sparql(session=self.session)
+        # WDQS answers with a few large queries, the Wikidata API is up to date but needs many small requests
+        self._sitelink_source = sitelink_source
+        if sitelink_source == 'wdqs':
+            self.sitelink_source = WdqsSitelinkSource(self.wikidata)
+        elif sitelink_source == 'api':
+            self.sitelink_source = ApiSitelinkSource(self.get_site(wikidata_domain))
+        else:
+            raise ValueError(f'Unknown sitelink source {sitelink_source}')
         self.primary_site = self.get_site(primary_domain)
 
     def __enter__(self):
@@ -59,6 +143,7 @@ class SessionState:
     def __exit__(self, typ, value, traceback):
         self.session.close()
         if self._cache is not None:
+            self.flush()
             self._cache.close()
             self._cache = None
             print(f'Closed SQL connection for {self._session_key} at {datetime.utcnow()}')
@@ -67,7 +152,38 @@ class SessionState:
         if self._cache is None:
             print(f'Opening SQL connection for {self._session_key} at {datetime.utcnow()}')
             self._cache_file.parent.mkdir(parents=True, exist_ok=True)
-            self._cache = SqliteDict(self._cache_file, autocommit=True)
+            # Values are stored already encoded by the codec. WAL lets other processes read the cache while
+            # a large transaction is being written. All connections must use it, or opening one switches the file back.
+            self._cache = SqliteDict(self._cache_file, autocommit=not self._write_behind, journal_mode='WAL',
+                                     encode=_identity, decode=_identity)
+
+    def flush(self) -> None:
+        """
+        Commit all pending SQLite writes
+        """
+        with self._pending_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._cache is not None and self._pending_items:
+                print(f"%% flush {self._pending_items} writes, {self._pending_bytes} bytes")
+                self._cache.commit()
+            self._pending_items = 0
+            self._pending_bytes = 0
+
+    def _written(self, items: int, size: int) -> None:
+        if not self._write_behind:
+            return
+        with self._pending_lock:
+            self._pending_items += items
+            self._pending_bytes += size
+            full = self._pending_items >= self._flush_max_items or self._pending_bytes >= self._flush_max_bytes
+            if not full and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_interval.total_seconds(), self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if full:
+            self.flush()
 
     def get_site(self, domain: Domain) -> WikiSite:
         try:
@@ -80,32 +196,320 @@ class SessionState:
             self.sites[domain] = site
             return site
 
-    def delete_cached_items(self, prefix: str) -> None:
+    def cached_keys(self, prefix: str) -> List[str]:
+        """
+        All keys in the backing store that start with the given prefix
+        """
         self._open()
-        for vv in {v for v in self._cache.keys() if v.startswith(prefix)}:
-            del self._cache[vv]
+        condition, params = _prefix_range(prefix)
+        return [key for key, in self._cache.conn.select(
+            f'SELECT key FROM "{self._cache.tablename}" WHERE {condition}', params)]
+
+    def delete_cached_items(self, prefix: str) -> int:
+        """
+        Delete all keys that start with the given prefix from SQLite and from Redis. Returns the number of deleted keys.
+        """
+        keys = set(self.cached_keys(prefix))
+        if keys:
+            condition, params = _prefix_range(prefix)
+            self._cache.conn.execute(f'DELETE FROM "{self._cache.tablename}" WHERE {condition}', params)
+            if self._write_behind:
+                self._written(len(keys), 0)
+            else:
+                self._cache.commit()
+        # Redis has no ordered index, but SCAN filters the keys on the server and does not block it
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self.redis_key(prefix)) + '*'
+        skip = len(self._cache_key)
+        batch = []
+        for redis_key in self._redis.scan_iter(match=pattern, count=1000):
+            batch.append(redis_key)
+            keys.add(redis_key.decode()[skip:])
+            if len(batch) >= 1000:
+                self._redis.unlink(*batch)
+                batch = []
+        if batch:
+            self._redis.unlink(*batch)
+        self._invalidate(keys)
+        print(f"%% del {len(keys)} keys with prefix {prefix}")
+        return len(keys)
 
     def del_obj(self, key: str) -> Any:
         self._redis.delete(self.redis_key(key))
+        self._invalidate([key])
         self._open()
         print(f"%% del {key}")
-        return self._cache.pop(key, None)
+        value = self._decode(key, self._cache.pop(key, None))
+        self._written(1, 0)
+        return None if value is _missing else value
 
     def load_obj(self, key: str, default: Any = None) -> Any:
-        value = self._redis.get(self.redis_key(key))
-        if value is not None:
-            return loads(value)
+        if self._use_memory:
+            value = self._memory.get(key, _missing)
+            if value is not _missing:
+                return value
+        data = self._redis.get(self.redis_key(key))
+        if data is not None:
+            value = self._decode(key, data)
+            if value is not _missing:
+                self._remember(key, value, data)
+                return value
         self._open()
         print(f"%% load {key}")
-        value = self._cache.get(key, default)
-        self._redis.set(self.redis_key(key), dumps(value))
+        value = self._decode(key, self._cache.get(key, None))
+        if value is _missing:
+            value = default
+        data = self._encode(key, value)
+        self._redis.set(self.redis_key(key), data)
+        self._remember(key, value, data)
         return value
 
     def save_obj(self, key: str, value: Any):
         self._open()
         print(f"%% save {key}")
-        self._cache[key] = value
-        self._redis.set(self.redis_key(key), dumps(value))
+        data = self._encode(key, value)
+        self._cache[key] = data
+        self._written(1, len(data))
+        self._redis.set(self.redis_key(key), data)
+        self._invalidate([key])
+
+    def load_timed(self, key: str, ttl: timedelta,
+                   revalidate: Callable[['SessionState'], None]) -> Tuple[Any, Optional[datetime], bool]:
+        """
+        Load a value saved with save_timed(). Returns the value, the time it was saved, and whether the caller must
+        refresh it right away. User requests get a stale value right away, and a single revalidate(state) call
+        is scheduled in the background with a new refresher session. The caller must refresh missing values,
+        and stale values outside of the user requests.
+        """
+        ts, value = self.load_obj(key, (None, None))
+        if ts is None:
+            return None, None, True
+        age = datetime.utcnow() - ts
+        if age <= ttl:
+            return value, ts, False
+        if not self.user_requested:
+            return value, ts, True
+        print(f"%% stale {key}, age {age}")
+        self.revalidate(key, revalidate)
+        return value, ts, False
+
+    def save_timed(self, key: str, value: Any) -> datetime:
+        ts = datetime.utcnow()
+        self.save_obj(key, (ts, value))
+        return ts
+
+    def lock_refresh(self) -> bool:
+        """
+        Take the lock shared by the refresher and the revalidations of all processes, so that only one of them
+        updates the state at a time. Returns False if it is already taken. Release it with unlock_refresh().
+        """
+        if not _refresh_lock.acquire(blocking=False):
+            return False
+        lock_key = self.redis_key('refreshing')
+        token = uuid4().hex
+        timeout_ms = int(self._refresh_timeout.total_seconds() * 1000)
+        if not self._redis.set(lock_key, token, nx=True, px=timeout_ms):
+            _refresh_lock.release()
+            return False
+        stopped = threading.Event()
+        self._refresh_lock = (token, stopped)
+
+        def renew():
+            while not stopped.wait(self._refresh_timeout.total_seconds() / 3):
+                try:
+                    if not self._redis.eval(_renew_script, 1, lock_key, token, timeout_ms):
+                        print(f"%% refresh lock of {self._session_key} has expired, another refresh may be running")
+                        return
+                except Exception:
+                    # Retried on the next renewal, there is still time before the lock expires
+                    traceback.print_exc()
+
+        threading.Thread(target=renew, daemon=True).start()
+        return True
+
+    def unlock_refresh(self) -> None:
+        token, stopped = self._refresh_lock
+        self._refresh_lock = None
+        stopped.set()
+        self._redis.eval(_unlock_script, 1, self.redis_key('refreshing'), token)
+        _refresh_lock.release()
+
+    def revalidate(self, key: str, revalidate: Callable[['SessionState'], None]) -> None:
+        """
+        Run revalidate(state) in a background thread with a new refresher session,
+        unless this or another process is already refreshing the state.
+        """
+        if not self.lock_refresh():
+            return
+
+        def run():
+            print(f"%% revalidating {key} at {datetime.utcnow()}")
+            try:
+                with SessionState(self._cache_file, self._cache_key, self._redis_host, codec=self._codec,
+                                  memory=self._memory, sitelink_source=self._sitelink_source) as state:
+                    revalidate(state)
+                print(f"%% revalidated {key} at {datetime.utcnow()}")
+            except Exception:
+                print(f"%% failed to revalidate {key}")
+                traceback.print_exc()
+            finally:
+                self.unlock_refresh()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def load_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Load multiple objects with a single Redis round trip. Missing keys are not included in the result.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        result = {}
+        if self._use_memory:
+            for key in keys:
+                value = self._memory.get(key, _missing)
+                if value is not _missing:
+                    result[key] = value
+            if result:
+                keys = [key for key in keys if key not in result]
+                if not keys:
+                    return result
+        missing = []
+        for key, data in zip(keys, self._redis.mget([self.redis_key(k) for k in keys])):
+            value = _missing if data is None else self._decode(key, data)
+            if value is not _missing:
+                result[key] = value
+                self._remember(key, value, data)
+            else:
+                missing.append(key)
+        if missing:
+            self._open()
+            print(f"%% load {len(missing)} keys, starting with {missing[0]}")
+            pipe = self._redis.pipeline(transaction=False)
+            for key, data in self._select_many(missing).items():
+                value = self._decode(key, data)
+                if value is not _missing:
+                    result[key] = value
+                    pipe.set(self.redis_key(key), data)
+                    self._remember(key, value, data)
+            pipe.execute()
+        return result
+
+    def save_many(self, items: Dict[str, Any]) -> None:
+        if not items:
+            return
+        self._open()
+        print(f"%% save {len(items)} keys, starting with {next(iter(items))}")
+        encoded = {key: self._encode(key, value) for key, value in items.items()}
+        # All rows are written in a single transaction
+        self._cache.update(encoded)
+        self._written(len(encoded), sum(len(v) for v in encoded.values()))
+        pipe = self._redis.pipeline(transaction=False)
+        for key, data in encoded.items():
+            pipe.set(self.redis_key(key), data)
+        pipe.execute()
+        self._invalidate(encoded.keys())
+
+    def del_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        self._redis.delete(*(self.redis_key(k) for k in keys))
+        self._invalidate(keys)
+        self._open()
+        print(f"%% del {len(keys)} keys, starting with {keys[0]}")
+        for batch in batches(keys, self._sql_batch_size):
+            self._cache.conn.execute(
+                f'DELETE FROM "{self._cache.tablename}" WHERE key IN ({",".join("?" * len(batch))})', batch)
+        if self._write_behind:
+            self._written(len(keys), 0)
+        else:
+            self._cache.commit()
+
+    def load_fields(self, prefix: str, fields: Iterable[str]) -> Dict[str, Any]:
+        """
+        Load some entries of a sharded object. Each entry is stored as a field of a Redis hash named by the prefix,
+        and as a separate SQLite row keyed by the prefix and the field name. Missing entries are not included.
+        """
+        fields = list(fields)
+        if not fields:
+            return {}
+        result = {}
+        if self._use_memory:
+            for field in fields:
+                value = self._memory.get(prefix + field, _missing, field=True)
+                if value is not _missing:
+                    result[field] = value
+            if result:
+                fields = [field for field in fields if field not in result]
+                if not fields:
+                    return result
+        missing = []
+        for field, data in zip(fields, self._redis.hmget(self.redis_key(prefix), fields)):
+            value = _missing if data is None else self._decode(prefix + field, data)
+            if value is not _missing:
+                result[field] = value
+                self._remember(prefix + field, value, data, field=True)
+            else:
+                missing.append(field)
+        if missing:
+            self._open()
+            print(f"%% load {len(missing)} fields of {prefix}, starting with {missing[0]}")
+            found = self._select_many([prefix + field for field in missing])
+            restore = {}
+            for field in missing:
+                value = self._decode(prefix + field, found.get(prefix + field))
+                if value is not _missing:
+                    result[field] = value
+                    restore[field] = found[prefix + field]
+                    self._remember(prefix + field, value, restore[field], field=True)
+            if restore:
+                self._redis.hset(self.redis_key(prefix), mapping=restore)
+        return result
+
+    def save_fields(self, prefix: str, items: Dict[str, Any]) -> None:
+        if not items:
+            return
+        self._open()
+        print(f"%% save {len(items)} fields of {prefix}, starting with {next(iter(items))}")
+        encoded = {field: self._encode(prefix + field, value) for field, value in items.items()}
+        self._cache.update({prefix + field: data for field, data in encoded.items()})
+        self._written(len(encoded), sum(len(v) for v in encoded.values()))
+        self._redis.hset(self.redis_key(prefix), mapping=encoded)
+        self._invalidate(prefix + field for field in encoded.keys())
+
+    def _select_many(self, keys: List[str]) -> Dict[str, bytes]:
+        found = {}
+        for batch in batches(keys, self._sql_batch_size):
+            for key, data in self._cache.conn.select(
+                    f'SELECT key, value FROM "{self._cache.tablename}" WHERE key IN ({",".join("?" * len(batch))})',
+                    batch):
+                found[key] = data
+        return found
+
+    @property
+    def _use_memory(self) -> bool:
+        return self._memory is not None and self.user_requested
+
+    def _remember(self, key: str, value: Any, data: bytes, field: bool = False) -> None:
+        if self._use_memory:
+            self._memory.put(key, value, len(data), field)
+
+    def _invalidate(self, keys: Iterable[str]) -> None:
+        if self._memory is not None:
+            self._memory.invalidate(keys)
+
+    def _encode(self, key: str, value: Any) -> bytes:
+        return add_version(key, self._codec.encode(value))
+
+    def _decode(self, key: str, data: Optional[bytes]) -> Any:
+        if data is None:
+            return _missing
+        try:
+            return decode_value(key, data, self._codec.decode)
+        except SchemaError as err:
+            # Stored with an older layout, treat as missing
+            print(f"%% outdated {key}: {err}")
+            return _missing
 
     def redis_key(self, key: str):
         return self._cache_key + key
@@ -0,0 +1,154 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from functools import partial
+from typing import Iterable, List, Set, Dict, Iterator
+
+from pywikiapi import AttrDict
+
+from .DataTypes import QID, Title, WdSitelink, WdWarning
+from .FetchPool import FetchPool
+from .Sparql import Sparql
+from .WikiSite import WikiSite
+from .utils import parse_wd_sitelink, parse_qid, primary_domain, title_to_url, batches
+
+# Instance of "MediaWiki page copied to multiple sites" - the primary pages
+multi_site_class = 'Q63090714'
+# Instance of "MediaWiki page not copied to multiple sites" - pages that are copied by hand
+non_multi_site_class = 'Q98545791'
+
+
+@dataclass
+class WdItem:
+    qid: QID
+    # Only the classes that matter: multi_site_class and non_multi_site_class
+    classes: Set[QID]
+    sitelinks: List[WdSitelink]
+
+
+class SitelinkSource(ABC):
+    """
+    Where the Wikidata items of the pages and their sitelinks come from
+    """
+
+    @abstractmethod
+    def query_items(self, titles: Iterable[Title]) -> Iterable[WdItem]:
+        """
+        Items with a sitelink to any of the given titles of the primary site, with all of their sitelinks
+        """
+
+    @abstractmethod
+    def query_primaries(self, warnings: List[WdWarning]) -> Iterable[WdSitelink]:
+        """
+        Primary site sitelinks of all instances of the multi_site_class
+        """
+
+
+class WdqsSitelinkSource(SitelinkSource):
+    """
+    Queries the Wikidata Query Service. A few large queries, but WDQS may lag behind Wikidata by several minutes.
+    """
+
+    def __init__(self, wikidata: Sparql):
+        self.wikidata = wikidata
+
+    def query_items(self, titles: Iterable[Title]) -> Iterable[WdItem]:
+        query = '''\
+SELECT ?id ?sl ?is_multi ?is_non_multi
+WHERE {
+  VALUES ?mw {
+%%%
+  }
+  ?mw schema:about ?id.
+  ?sl schema:about ?id.
+  BIND( EXISTS {?id wdt:P31 wd:Q63090714} AS ?is_multi)
+  BIND( EXISTS {?id wdt:P31 wd:Q98545791} AS ?is_non_multi)
+}'''
+
+        items: Dict[QID, WdItem] = {}
+        # Large lists of titles are split into several queries, because WDQS times out on a very large VALUES list
+        for entity, sitelink, is_multi, is_non_multi in self.wikidata.query_values(
+                query, (f'<{title_to_url(primary_domain, v)}>' for v in sorted(titles))):
+            qid = parse_qid(entity)
+            item = items.get(qid)
+            if item is None:
+                item = items[qid] = WdItem(qid, set(), [])
+                if is_multi == 'true':
+                    item.classes.add(multi_site_class)
+                if is_non_multi == 'true':
+                    item.classes.add(non_multi_site_class)
+            res = parse_wd_sitelink(qid, sitelink)
+            if res:
+                item.sitelinks.append(res)
+        return items.values()
+
+    def query_primaries(self, warnings: List[WdWarning]) -> Iterable[WdSitelink]:
+        query = '''\
+SELECT ?id ?sl WHERE {
+  ?id wdt:P31 wd:Q63090714.
+  ?sl schema:about ?id;
+      schema:isPartOf <https://%%%/>.
+}'''.replace('%%%', primary_domain)
+        for entity, sitelink in self.wikidata.query(query):
+            res = parse_wd_sitelink(parse_qid(entity), sitelink, warnings)
+            if res:
+                yield res
+
+
+class ApiSitelinkSource(SitelinkSource):
+    """
+    Gets the items from the Wikidata API, 50 at a time, several requests at once. Always up to date,
+    but the list of primaries comes from the search index, which may also lag behind by a few minutes.
+    """
+    # Maximum number of items per wbgetentities request
+    _batch_size = 50
+    _primary_site_id = 'mediawikiwiki'
+
+    def __init__(self, site: WikiSite, max_workers: int = 4):
+        self.site = site
+        self.max_workers = max_workers
+
+    def query_items(self, titles: Iterable[Title]) -> Iterator[WdItem]:
+        with FetchPool(self.max_workers, self.max_workers) as pool:
+            for items in pool.imap((self.site.domain, partial(self._get_items, sites=self._primary_site_id,
+                                                              titles=batch))
+                                   for batch in batches(sorted(titles), self._batch_size)):
+                yield from items
+
+    def query_primaries(self, warnings: List[WdWarning]) -> Iterator[WdSitelink]:
+        qids = [v.title
+                for res in self.site.query(list='search', srsearch=f'haswbstatement:P31={multi_site_class}',
+                                           srnamespace=0, srlimit='max', srprop='')
+                for v in res.search]
+        for item in self.query_entities(qids):
+            # The search index may not be up to date
+            if multi_site_class in item.classes:
+                yield from (v for v in item.sitelinks if v.domain == primary_domain)
+
+    def query_entities(self, qids: Iterable[QID]) -> Iterator[WdItem]:
+        """
+        Current state of the given items. Deleted items are skipped.
+        """
+        with FetchPool(self.max_workers, self.max_workers) as pool:
+            for items in pool.imap((self.site.domain, partial(self._get_items, ids=batch))
+                                   for batch in batches(sorted(qids), self._batch_size)):
+                yield from items
+
+    def _get_items(self, **params) -> List[WdItem]:
+        # Runs in a pool thread
+        res = self.site('wbgetentities', props=['sitelinks/urls', 'claims'], **params)
+        items = []
+        for entity in res.entities.values():
+            if 'missing' in entity:
+                continue
+            classes = {multi_site_class, non_multi_site_class}.intersection(self._truthy_values(entity, 'P31'))
+            sitelinks = [parse_wd_sitelink(entity.id, v.url) for v in entity.get('sitelinks', {}).values()]
+            items.append(WdItem(entity.id, classes, [v for v in sitelinks if v]))
+        return items
+
+    @staticmethod
+    def _truthy_values(entity: AttrDict, prop: str) -> Set[QID]:
+        # Same as wdt: in WDQS - preferred statements if there are any, normal ones otherwise
+        claims = [v for v in entity.get('claims', {}).get(prop, []) if v.rank != 'deprecated']
+        if any(v.rank == 'preferred' for v in claims):
+            claims = [v for v in claims if v.rank == 'preferred']
+        return {v.mainsnak.datavalue.value.id for v in claims if v.mainsnak.snaktype == 'value'}
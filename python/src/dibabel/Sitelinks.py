@@ -1,105 +1,179 @@
-from datetime import timedelta
-from typing import Iterable, Dict, List
+from datetime import timedelta, datetime
+from functools import partial
+from typing import Iterable, Dict, List, Set, Tuple
 
 from .DataTypes import TitleSitelinks, WdWarning, Title
+from .FetchPool import FetchPool
+from .Schema import key_family
 from .SessionState import SessionState
-from .utils import batches, title_to_url, parse_wd_sitelink, parse_qid, primary_domain
+from .SitelinkSource import multi_site_class, non_multi_site_class, WdItem
+from .WikiSite import WikiSite
+from .utils import batches, primary_domain, is_older_than
 
 
 class Sitelinks:
-    _cache_key = 'title_sitelinks'
+    """
+    Sitelinks are stored separately for each title, and loaded on demand, or in bulk with preload()
+    """
+    _cache_prefix = 'title_sitelinks:'
+    # When each title was last fetched, only needed by refresh(), so it is stored apart from the sitelinks
+    _fetched_prefix = 'title_fetched:'
+    # Maximum number of titles per request, and number of concurrent requests to resolve the titles
+    _batch_size = 50
+    _resolve_fetches = 4
     _warnings: List[WdWarning]
 
-    # Template name -> domain -> localized template name
+    # Template name -> domain -> localized template name, only the loaded titles
     _sitelinks: Dict[Title, TitleSitelinks]
+    # Titles that were looked up, but are not stored
+    _unknown: Set[Title]
+    # Titles that were modified since they were loaded
+    _dirty: Set[Title]
     _ttl: timedelta
 
     def __init__(self, state: SessionState, warnings: List[WdWarning]):
         self._state = state
         self._warnings = warnings
         self._ttl = timedelta(hours=1)
-        self._sitelinks = state.load_obj(self._cache_key) or {}
+        self._sitelinks = {}
+        self._unknown = set()
+        self._dirty = set()
 
     def __getitem__(self, title: Title) -> TitleSitelinks:
-        return self._sitelinks[title]
-
-    def refresh(self, titles: Iterable[Title]) -> None:
-        # Ask source to resolve titles
+        try:
+            return self._sitelinks[title]
+        except KeyError:
+            self.preload([title])
+            return self._sitelinks[title]
+
+    def preload(self, titles: Iterable[Title]) -> None:
+        """
+        Load sitelinks of all given titles with a single request
+        """
+        titles = {v for v in titles if v not in self._sitelinks and v not in self._unknown}
+        if titles:
+            self._sitelinks.update(self._state.load_fields(self._cache_prefix, titles))
+            self._unknown.update(titles.difference(self._sitelinks))
+
+    def _set(self, title: Title, value: TitleSitelinks) -> None:
+        self._sitelinks[title] = value
+        self._unknown.discard(title)
+        self._dirty.add(title)
+
+    def refresh(self, titles: Iterable[Title], force: bool = False) -> int:
+        """
+        Resolve the titles on the primary site, and get the sitelinks of their Wikidata items. Titles that were
+        fetched less than _ttl ago are skipped, unless forced. Returns the number of titles that were fetched.
+        """
+        titles = set(titles)
+        self.preload(titles)
+        if not force:
+            fetched_times = self._state.load_fields(self._fetched_prefix, titles)
+            titles = {v for v in titles if v not in self._sitelinks or is_older_than(fetched_times.get(v), self._ttl)}
+        if not titles:
+            return 0
+        fetched = datetime.utcnow()
+
+        # Ask source to resolve titles, several batches at once
         normalized = {}
         redirects = {}
         missing = set()
         pages = set()
-        for batch in batches(sorted(set(titles)), 50):
-            res = next(self._state.primary_site.query(titles=batch, redirects=True))
-            if 'normalized' in res:
-                normalized.update({v['from']: v.to for v in res.normalized})
-            if 'redirects' in res:
-                redirects.update({v['from']: v.to for v in res.redirects})
-            for v in res.pages:
-                if 'missing' in v:
-                    missing.add(v['title'])
-                else:
-                    pages.add(v['title'])
-
-        qid_primary, qid_copies = self._query_wikidata(pages)
-
-        for title in pages:
-            if title not in self._sitelinks:
-                self._sitelinks[title] = TitleSitelinks(None, title, 'no_wd', {})
+        site = self._state.primary_site
+        with FetchPool(self._resolve_fetches, self._resolve_fetches) as pool:
+            for res_normalized, res_redirects, res_missing, res_pages in pool.imap(
+                    (site.domain, partial(self._resolve, site, batch))
+                    for batch in batches(sorted(titles), self._batch_size)):
+                normalized.update(res_normalized)
+                redirects.update(res_redirects)
+                missing.update(res_missing)
+                pages.update(res_pages)
+
+        # Refreshed entries are replaced rather than modified, so the old values can be compared with the new ones
+        touched = titles.union(pages, redirects.values(), normalized.values())
+        self.preload(touched)
+        old_values = {title: self._sitelinks[title] for title in touched if title in self._sitelinks}
+
+        found = self._apply_items(self._state.sitelink_source.query_items(pages))
+
+        for title in pages.difference(found):
+            self._set(title, TitleSitelinks(None, title, 'no_wd', {}))
 
         for frm, to in redirects.items():
             try:
-                self._sitelinks[frm] = self._sitelinks[to]
+                self._set(frm, self._sitelinks[to])
             except KeyError:
-                self._sitelinks[frm] = TitleSitelinks(None, frm, 'missing', {})
+                self._set(frm, TitleSitelinks(None, frm, 'missing', {}))
 
         for frm, to in normalized.items():
             try:
-                self._sitelinks[frm] = self._sitelinks[to]
+                self._set(frm, self._sitelinks[to])
             except KeyError:
                 # Save normalized title
-                self._sitelinks[frm] = TitleSitelinks(None, to, 'missing', {})
+                self._set(frm, TitleSitelinks(None, to, 'missing', {}))
 
-        # Ensure all titles are present in cache
         for title in missing:
-            if title not in self._sitelinks:
-                self._sitelinks[title] = TitleSitelinks(None, title, 'missing', {})
-
-        # Update sitelinks for copies
-        for row in qid_copies:
-            self._sitelinks[qid_primary[row.qid]].domain_to_title[row.domain] = row.title
-
-        self._state.save_obj(self._cache_key, self._sitelinks)
-
-    def _query_wikidata(self, titles: Iterable[Title]):
-        values = "\n".join((f'<{title_to_url(primary_domain, v)}>' for v in titles))
-        query = f'''\
-SELECT ?id ?sl ?is_multi ?is_non_multi
-WHERE {{ 
-  VALUES ?mw {{
-{values}
-  }}
-  ?mw schema:about ?id.
-  ?sl schema:about ?id.
-  BIND( EXISTS {{?id wdt:P31 wd:Q63090714}} AS ?is_multi)
-  BIND( EXISTS {{?id wdt:P31 wd:Q98545791}} AS ?is_non_multi)
-}}'''
-
-        query_result = self._state.wikidata.query(query)
-        qid_copies = []
-        qid_primary = {}
-
-        for row in query_result:
-            qid = parse_qid(row)
-            is_multi = row['is_multi']['value'] == 'true'
-            is_non_multi = row['is_non_multi']['value'] == 'true'
-            res = parse_wd_sitelink(qid, row['sl']['value'])
-            if res:
-                if res.domain == primary_domain:
-                    qid_primary[qid] = res.title
-                    status = 'sync' if is_multi else 'manual_sync' if is_non_multi else 'no_sync'
-                    self._sitelinks[res.title] = TitleSitelinks(qid, res.title, status, {})
-                else:
-                    qid_copies.append(res)
+            self._set(title, TitleSitelinks(None, title, 'missing', {}))
+
+        self._save(old_values, fetched)
+        print(f'Fetched sitelinks of {len(titles)} titles')
+        return len(titles)
 
-        return qid_primary, qid_copies
+    @staticmethod
+    def _resolve(site: WikiSite, titles: List[Title]) \
+            -> Tuple[Dict[Title, Title], Dict[Title, Title], Set[Title], Set[Title]]:
+        # Runs in a pool thread. Returns normalized and redirected titles, missing titles, and existing pages.
+        normalized = {}
+        redirects = {}
+        missing = set()
+        pages = set()
+        for res in site.query(titles=titles, redirects=True):
+            if 'normalized' in res:
+                normalized.update({v['from']: v.to for v in res.normalized})
+            if 'redirects' in res:
+                redirects.update({v['from']: v.to for v in res.redirects})
+            for v in res.get('pages', []):
+                if 'missing' in v:
+                    missing.add(v['title'])
+                else:
+                    pages.add(v['title'])
+        return normalized, redirects, missing, pages
+
+    def update_items(self, items: Iterable[WdItem]) -> None:
+        """
+        Replace the sitelinks of the primary site pages of the given items, e.g. after the items were edited.
+        Unlike refresh(), the titles are not resolved, and the items are not queried again.
+        """
+        items = list(items)
+        titles = {v.title for item in items for v in item.sitelinks if v.domain == primary_domain}
+        self.preload(titles)
+        old_values = {title: self._sitelinks[title] for title in titles if title in self._sitelinks}
+        self._apply_items(items)
+        self._save(old_values, datetime.utcnow())
+
+    def _save(self, old_values: Dict[Title, TitleSitelinks], fetched: datetime) -> None:
+        # Unchanged entries are not saved again, but they are still marked as fetched
+        self._state.save_fields(self._cache_prefix, {
+            title: self._sitelinks[title] for title in self._dirty if self._sitelinks[title] != old_values.get(title)})
+        self._state.save_fields(self._fetched_prefix, {title: fetched for title in self._dirty})
+        self._dirty.clear()
+
+    def _apply_items(self, items: Iterable[WdItem]) -> Set[Title]:
+        """
+        Set the sitelinks of the primary site page of each item, and return the titles of these pages
+        """
+        titles = set()
+        for item in items:
+            primary = next((v.title for v in item.sitelinks if v.domain == primary_domain), None)
+            if primary is None:
+                continue
+            status = 'sync' if multi_site_class in item.classes \
+                else 'manual_sync' if non_multi_site_class in item.classes else 'no_sync'
+            copies = {v.domain: v.title for v in item.sitelinks if v.domain != primary_domain}
+            self._set(primary, TitleSitelinks(item.qid, primary, status, copies))
+            titles.add(primary)
+        return titles
+
+
+key_family(Sitelinks._cache_prefix)
+key_family(Sitelinks._fetched_prefix)
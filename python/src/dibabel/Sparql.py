@@ -1,23 +1,129 @@
+import csv
+from functools import partial
+from io import TextIOWrapper
+from time import sleep
+from typing import Iterable, List, Optional, Iterator, Tuple
+from urllib.parse import urlparse
+
 import requests
+from requests import Session
+
+from .FetchPool import FetchPool
+from .MemoryCache import MemoryCache
+from .utils import batches
+
+# Query results shared by all sessions of the process, so that the same query is not repeated right away
+_results = MemoryCache(max_entries=100, max_size=64 * 1024 * 1024, max_age=120)
 
 
 class Sparql:
+    """
+    Wikidata Query Service client. All requests share the session's connections, and are retried with
+    an increasing delay if the service is overloaded or unavailable. Results are cached for a short time,
+    keyed by the query text without the insignificant whitespace. Only small results are cached, the large ones,
+    such as the full list of primaries, are streamed without being collected.
+    """
+    _retry_statuses = {429, 500, 502, 503, 504}
+
     def __init__(self,
-                 rdf_url='https://query.wikidata.org/bigdata/namespace/wdq/sparql'):
+                 rdf_url='https://query.wikidata.org/bigdata/namespace/wdq/sparql',
+                 session: Session = None,
+                 max_values: int = 200,
+                 max_workers: int = 4,
+                 max_retries: int = 4,
+                 backoff: float = 1.0,
+                 cache: Optional[MemoryCache] = _results,
+                 max_cached_size: int = 1024 * 1024):
         self.rdf_url = rdf_url
+        self.session = session or Session()
+        # Queries with a larger VALUES list are split into several queries, which run concurrently.
+        # WDQS allows up to 5 concurrent queries per client.
+        self.max_values = max_values
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache
+        # Results with more characters than this are not cached
+        self.max_cached_size = max_cached_size
 
-    def query(self, sparql):
+    def query(self, sparql: str) -> Iterator[Tuple[str, ...]]:
+        """
+        Run the query, and yield each result row as a tuple of the values of the SELECT variables, in their order.
+        Unbound values are empty strings. The result is parsed as it is being downloaded, without keeping
+        the whole response in memory.
+        """
+        key = ' '.join(sparql.split())
+        if self.cache is not None:
+            rows = self.cache.get(key)
+            if rows is not None:
+                yield from rows
+                return
         print(f"Querying WDQS:  {sparql}")
-        headers = {
-            'Accept': 'application/sparql-results+json',
-            'User-Agent': 'Dibabel Bot (User:Yurik, YuriAstrakhan@gmail.com)'
-        }
-        r = requests.post(self.rdf_url, data={'query': sparql}, headers=headers)
+        rows = [] if self.cache is not None else None
+        size = 0
+        r = self._post(sparql)
         try:
-            if not r.ok:
-                print(r.reason)
-                print(sparql)
-                raise Exception(r.reason)
-            return r.json()['results']['bindings']
+            r.raw.decode_content = True
+            reader = csv.reader(TextIOWrapper(r.raw, encoding='utf-8', newline=''))
+            # The first row has the variable names
+            next(reader, None)
+            for row in reader:
+                row = tuple(row)
+                if rows is not None:
+                    size += sum(len(v) for v in row)
+                    if size > self.max_cached_size:
+                        # Too large to cache, stop collecting the rows
+                        rows = None
+                    else:
+                        rows.append(row)
+                yield row
         finally:
             r.close()
+        if rows is not None:
+            self.cache.put(key, rows, size)
+
+    def query_values(self, sparql: str, values: Iterable[str]) -> Iterator[Tuple[str, ...]]:
+        """
+        Run a query with a VALUES list in place of the "%%%" in the query text. Each query gets at most max_values
+        of the values, and the results of all queries are combined.
+        """
+        queries = [sparql.replace('%%%', '\n'.join(batch)) for batch in batches(values, self.max_values)]
+        if len(queries) == 1:
+            yield from self.query(queries[0])
+            return
+        host = urlparse(self.rdf_url).hostname
+        # Only as many results as there are workers are kept in memory
+        with FetchPool(self.max_workers, self.max_workers, self.max_workers) as pool:
+            for rows in pool.imap((host, partial(self._query_list, query)) for query in queries):
+                yield from rows
+
+    def _query_list(self, sparql: str) -> List[Tuple[str, ...]]:
+        return list(self.query(sparql))
+
+    def _post(self, sparql: str) -> requests.Response:
+        headers = {
+            'Accept': 'text/csv',
+            'User-Agent': 'Dibabel Bot (User:Yurik, YuriAstrakhan@gmail.com)'
+        }
+        attempt = 0
+        while True:
+            try:
+                r = self.session.post(self.rdf_url, data={'query': sparql}, headers=headers, stream=True)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+            else:
+                if r.ok:
+                    return r
+                if r.status_code not in self._retry_statuses or attempt >= self.max_retries:
+                    print(r.reason)
+                    print(sparql)
+                    r.close()
+                    raise Exception(r.reason)
+                retry_after = r.headers.get('Retry-After', '')
+                delay = int(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+                r.close()
+            attempt += 1
+            print(f'WDQS request failed, retrying in {delay} seconds')
+            sleep(delay)
@@ -1,18 +1,28 @@
 from collections import defaultdict
+from datetime import datetime
+from functools import partial
 from sys import intern
-from typing import Dict, Optional, Iterable, Generator, Set, Tuple
+from typing import Dict, Optional, Iterable, Generator, Set, Tuple, List
 
-from .DataTypes import QID, SyncInfo, Domain
+from .ChangeFeed import ChangeFeed
+from .DataTypes import QID, SyncInfo, Domain, Title
+from .FetchPool import FetchPool
 from .Metadata import Metadata
-from .PageContent import TitlePagePair, PageContent
+from .PageContent import TitlePagePair, PageContent, TitleHashPair
+from .Primary import Primary
 from .PrimaryPages import PrimaryPages
+from .Schema import key_family
 from .SessionState import SessionState
 from .Sitelinks import Sitelinks
+from .WikiSite import WikiSite
 from .utils import calc_hash, title_to_url, primary_domain
 
 
 class Synchronizer:
     _cache_prefix = "info_by_qid:"
+    # Download limits for the concurrent requests to the wikis
+    _max_workers = 16
+    _max_per_host = 2
 
     def __init__(self, state: SessionState, primaries: PrimaryPages, sitelinks: Sitelinks, metadata: Metadata):
         self._state = state
@@ -21,6 +31,7 @@ class Synchronizer:
         self._metadata = metadata
         self._infos: Dict[QID, Dict[Domain, SyncInfo]] = {}
         self._modified_qids: Set[QID] = set()
+        self._localized_primaries: Dict[QID, Primary] = {}
 
     def get_info_by_qid(self, qid: QID) -> Dict[Domain, SyncInfo]:
         try:
@@ -29,6 +40,18 @@ class Synchronizer:
             self._infos[qid] = self._state.load_obj(f'{self._cache_prefix}{qid}', {})
             return self._infos[qid]
 
+    def _load_infos(self, qids: Iterable[QID]) -> None:
+        keys = {f'{self._cache_prefix}{qid}': qid for qid in qids if qid not in self._infos}
+        values = self._state.load_many(keys.keys())
+        for key, qid in keys.items():
+            self._infos[qid] = values.get(key) or {}
+
+    def delete_cached_pages(self, domain: Domain = None) -> int:
+        """
+        Drop the cached content of all pages of one domain, or of all domains
+        """
+        return self._state.delete_cached_items(title_to_url(domain, '') if domain else 'https://')
+
     def update_syncinfo(self, qid: QID = None, domain: Domain = None) -> Optional[Tuple[PageContent, SyncInfo]]:
         """
         Update sync info either for everything or just a single one.
@@ -46,21 +69,34 @@ class Synchronizer:
                 ns = meta.module_ns if primary.is_module else meta.template_ns
                 title = ns + ":" + primary.title.split(':', 1)[1]
             qid_by_domain_title = {domain: {title: qid}}
+            # A single copy may have been edited since it was cached, so its revision is always verified
+            verify = {domain}
+            changes = None
         else:
             qid_by_domain_title = defaultdict(dict)
+            tracked: Dict[Domain, Dict[Title, QID]] = defaultdict(dict)
+            self._load_infos(self._primaries.get_all_qids())
+            self._sitelinks.preload(page.title for _, page in self._primaries.get_all())
             for qid, page in self._primaries.get_all():
                 links = self._sitelinks[page.title]
                 inf = self.get_info_by_qid(qid)
                 for domain, title in links.domain_to_title.items():
+                    tracked[domain][title] = qid
                     if not inf or domain not in inf or inf[domain].dst_revid != page.last_rev_id:
                         qid_by_domain_title[domain][title] = qid
+            changes = ChangeFeed(self._state, 'pages')
+            verify = self._apply_changes(changes, tracked, qid_by_domain_title)
 
-        # Refresh by domain because we want to get all page statuses with one API call
+        # Refresh by domain because we want to get all page statuses with one API call.
         last_result = None
-        for domain, titles_qid in sorted(qid_by_domain_title.items(), key=lambda v: v[0]):
-            for title, page in self._get_page_content(domain, titles_qid.keys(), refresh=qid is not None):
-                qid = titles_qid[title]
-                inf = self.get_info_by_qid(qid)
+        start = datetime.utcnow()
+        domains = sorted(qid_by_domain_title.keys())
+        for domain, pages in self._get_pages_content(
+                {domain: qid_by_domain_title[domain] for domain in domains}, verify):
+            titles_qid = qid_by_domain_title[domain]
+            for title, page in pages:
+                page_qid = titles_qid[title]
+                inf = self.get_info_by_qid(page_qid)
                 if not inf or domain not in inf:
                     old_revid = 0
                 else:
@@ -68,24 +104,71 @@ class Synchronizer:
                 if page is not None and old_revid == page.revid:
                     info = inf[domain]
                 else:
-                    primary = self._primaries.get_page(qid, load_history=True)
+                    primary = self._get_localized_primary(page_qid)
                     metadata = self._metadata[domain]
                     if page is None:
                         last_rev = primary.last_revision
                         info = SyncInfo(
                             'new', primary.qid, primary.title, primary.last_rev_id, domain, title,
                             new_content=intern(
-                                primary.localize_content(last_rev.content, metadata, domain, self._sitelinks)),
+                                primary.localize_revision(last_rev, metadata, domain, self._sitelinks)),
                             hash=calc_hash(last_rev.content))
                     else:
                         info = primary.compute_sync_info(primary.qid, page, metadata, self._sitelinks)
                         self._update_info(primary.qid, domain, info)
                 last_result = (page, info)
+        if qid is None:
+            print(f'Updated sync info of {len(domains)} domains in {datetime.utcnow() - start}')
 
         self._save_updated_infos()
+        for primary in self._localized_primaries.values():
+            primary.save_localized(self._state)
+        self._localized_primaries.clear()
+        if changes:
+            # Only now the cached pages are known to be valid as of the new cursors
+            changes.commit()
 
         return None if qid is None else last_result
 
+    def _get_localized_primary(self, qid: QID) -> Primary:
+        """
+        Primary page with its history, whose localized content is saved at the end of the update
+        """
+        primary = self._localized_primaries.get(qid)
+        if primary is None:
+            primary = self._primaries.get_page(qid, load_history=True)
+            self._sitelinks.preload(primary.historic_dependencies)
+            self._localized_primaries[qid] = primary
+        return primary
+
+    def _apply_changes(self,
+                       changes: ChangeFeed,
+                       tracked: Dict[Domain, Dict[Title, QID]],
+                       qid_by_domain_title: Dict[Domain, Dict[Title, QID]]
+                       ) -> Set[Domain]:
+        """
+        Drop the cached pages that have changed since the previous refresh, and add the tracked copies
+        that need to be checked. Returns the domains whose cached pages must be verified by their revisions.
+        """
+        verify = set()
+        for domain, change in changes.poll([self._state.get_site(domain) for domain in sorted(tracked)]).items():
+            titles = tracked[domain]
+            if change.titles is None:
+                # Nothing is known about the cached pages of this wiki. The tracked ones are verified below,
+                # and the rest are dropped so that they are not trusted later.
+                keys = set(self._state.cached_keys(title_to_url(domain, '')))
+                self._state.del_many(keys.difference(title_to_url(domain, title) for title in titles))
+            else:
+                self._state.del_many(title_to_url(domain, title) for title in change.titles)
+            if change.verify_all:
+                qid_by_domain_title[domain].update(titles)
+                verify.add(domain)
+            else:
+                changed = {title: titles[title] for title in change.titles if title in titles}
+                if changed:
+                    qid_by_domain_title[domain].update(changed)
+        return verify
+
     def get_syncinfo(self, single_qid: Optional[str] = None) -> Dict[str, any]:
         if single_qid is None:
             qids = set(self._primaries.get_all_qids())
@@ -97,8 +180,9 @@ class Synchronizer:
         found = 0
         while found != len(qids):
             found = len(qids)
-            for qid in list(qids):
-                page = self._primaries.get_page(qid)
+            primaries = [self._primaries.get_page(qid) for qid in qids]
+            self._sitelinks.preload(title for page in primaries for title in (page.title, *page.dependencies))
+            for page in primaries:
                 for dep in page.dependencies:
                     sl = self._sitelinks[dep]
                     if sl.pageType == 'sync':
@@ -106,6 +190,7 @@ class Synchronizer:
                     else:
                         other_deps.add(sl.normalizedTitle)
 
+        self._load_infos(qids)
         pages = []
         for qid in qids:
             page = self._primaries.get_page(qid)
@@ -114,13 +199,14 @@ class Synchronizer:
                 type=self._sitelinks[page.title].pageType,
                 primarySite=primary_domain,
                 qid=qid,
-                primaryRevId=page.last_revision.revid,
+                primaryRevId=page.last_rev_id,
                 dependencies=[
                     vv.normalizedTitle
                     for vv in [self._sitelinks[v] for v in page.dependencies]],
                 copies=[self._info_obj(info) for info in self.get_info_by_qid(qid).values()]
             ))
 
+        self._sitelinks.preload(other_deps)
         for dep in sorted(other_deps):
             sl = self._sitelinks[dep]
             obj = dict(
@@ -136,48 +222,101 @@ class Synchronizer:
 
         return dict(pages=pages)
 
-    def _get_page_content(self,
-                          domain: Domain,
-                          titles: Iterable[str],
-                          refresh=False
-                          ) -> Generator[TitlePagePair, None, None]:
-        site = self._state.get_site(domain)
-
-        cached_pages = {}
-        unresolved: Set[str] = set()
-        for title in titles:
-            page = self._state.load_obj(title_to_url(site.domain, title))
-            if page:
-                cached_pages[title] = page
-            else:
-                unresolved.add(title)
+    def _get_pages_content(self,
+                           qid_by_domain_title: Dict[Domain, Dict[Title, QID]],
+                           verify: Set[Domain]
+                           ) -> Generator[Tuple[Domain, List[TitlePagePair]], None, None]:
+        """
+        Get page content of many domains, downloading from several domains at once.
+        The cached pages of the domains in verify are checked against their latest revisions.
+        Pages that are not cached are first looked up by the SHA1 of their content, and if it matches
+        a known revision of their primary page, the content is taken from the primary instead of downloading it.
+        The cache is only used by the calling thread, and the results are yielded in the order of the domains.
+        """
 
+        def requests():
+            for domain, titles in qid_by_domain_title.items():
+                site = self._state.get_site(domain)
+                cache_keys = {title: title_to_url(site.domain, title) for title in titles}
+                cached = self._state.load_many(cache_keys.values())
+                cached_pages = {}
+                unresolved: Set[str] = set()
+                for title, cache_key in cache_keys.items():
+                    page = cached.get(cache_key)
+                    if page:
+                        cached_pages[title] = page
+                    else:
+                        unresolved.add(title)
+                known_hashes = {}
+                if unresolved:
+                    metadata = self._metadata[domain]
+                    for title in unresolved:
+                        primary = self._get_localized_primary(titles[title])
+                        hashes = primary.known_hashes(metadata, domain, self._sitelinks)
+                        if hashes:
+                            known_hashes[title] = hashes
+                yield domain, partial(
+                    self._download_pages, site, cached_pages, unresolved, known_hashes, domain in verify)
+
+        with FetchPool(self._max_workers, self._max_per_host) as pool:
+            for domain, (result, outdated, downloaded, by_hash) in zip(
+                    qid_by_domain_title.keys(), pool.imap(requests())):
+                for title, page in by_hash:
+                    primary = self._get_localized_primary(qid_by_domain_title[domain][title])
+                    content = primary.content_by_hash(page.sha1, self._metadata[domain], domain, self._sitelinks)
+                    downloaded.append((title, page.to_content(domain, title, content)))
+                self._state.del_many(title_to_url(domain, title) for title in outdated)
+                self._state.save_many(
+                    {title_to_url(domain, title): page for title, page in downloaded if page is not None})
+                # ok if doesn't exist
+                self._state.del_many(title_to_url(domain, title) for title, page in downloaded if page is None)
+                yield domain, result + downloaded
+
+    @staticmethod
+    def _download_pages(site: WikiSite,
+                        cached_pages: Dict[Title, PageContent],
+                        unresolved: Set[Title],
+                        known_hashes: Dict[Title, Set[str]],
+                        refresh: bool
+                        ) -> Tuple[List[TitlePagePair], List[Title], List[TitlePagePair], List[TitleHashPair]]:
+        """
+        Runs in a pool thread, so it must not use the cache. Returns the pages that are still valid in the cache,
+        the titles that are no longer valid, the newly downloaded pages, and the pages whose content is known
+        by its hash.
+        """
+        result = []
+        outdated = []
         if cached_pages:
             if refresh:
                 for title, revid in site.query_pages_revid(cached_pages.keys()):
-                    cache_title = title_to_url(site.domain, title)
                     page = cached_pages.pop(title)
                     if revid == 0:
-                        self._state.del_obj(cache_title)
-                        yield title, None
+                        outdated.append(title)
+                        result.append((title, None))
                     elif revid != page.revid:
-                        self._state.del_obj(cache_title)
+                        outdated.append(title)
                         unresolved.add(title)
                     else:
-                        yield page.title, page
+                        result.append((page.title, page))
                 if cached_pages:
                     raise ValueError('Unexpected titles not found: ' + ', '.join(cached_pages.keys()))
             else:
-                yield from cached_pages.items()
+                result.extend(cached_pages.items())
 
-        if unresolved:
-            for title, page in site.query_pages_content(unresolved):
-                cache_title = title_to_url(site.domain, title)
+        downloaded = []
+        by_hash = []
+        lookup = unresolved.intersection(known_hashes)
+        if lookup:
+            for title, page in site.query_pages_hash(lookup):
                 if page is None:
-                    self._state.del_obj(cache_title)  # ok if doesn't exist
-                else:
-                    self._state.save_obj(cache_title, page)
-                yield title, page
+                    downloaded.append((title, None))
+                    unresolved.discard(title)
+                elif page.sha1 in known_hashes.get(title, ()):
+                    by_hash.append((title, page))
+                    unresolved.discard(title)
+        if unresolved:
+            downloaded.extend(site.query_pages_content(unresolved))
+        return result, outdated, downloaded, by_hash
 
     @staticmethod
     def _info_obj(p: SyncInfo):
@@ -198,6 +337,10 @@ class Synchronizer:
         self._modified_qids.add(qid)
 
     def _save_updated_infos(self) -> None:
-        for qid in self._modified_qids:
-            self._state.save_obj(f'{self._cache_prefix}{qid}', self._infos[qid])
+        self._state.save_many({f'{self._cache_prefix}{qid}': self._infos[qid] for qid in self._modified_qids})
         self._modified_qids.clear()
+
+
+key_family(Synchronizer._cache_prefix)
+# Page content of the copies, keyed by the page URL
+key_family('https://')
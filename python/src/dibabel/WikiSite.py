@@ -1,18 +1,25 @@
 import re
+from datetime import datetime
+from functools import partial
 from json import dumps
-from typing import List, Iterable, Tuple
+from typing import List, Iterable, Tuple, Sequence, Set, Optional, Iterator, Callable
 
 from pywikiapi import Site, AttrDict
+from pywikiapi.utils import to_timestamp
 # noinspection PyUnresolvedReferences
 from requests import Session
 
 from .DataTypes import RevComment, SiteMetadata, Domain, Title
-from .PageContent import PageContent, TitlePagePair
+from .FetchPool import FetchPool
+from .PageContent import PageContent, TitlePagePair, PageHash, TitleHashPair
+from .utils import batches
 
 reDomain = re.compile(r'^(?P<lang>[a-z0-9-_]+)\.(?P<project>[a-z0-9-_]+)\.org$', re.IGNORECASE)
 
 
 class WikiSite(Site):
+    # Maximum number of revisions whose content can be requested at once
+    _content_batch_size = 50
 
     def __init__(self, domain: Domain, session: Session, is_primary: bool):
         super().__init__(f'https://{domain}/w/api.php', session=session, json_object_hook=AttrDict)
@@ -27,7 +34,7 @@ class WikiSite(Site):
         self.project = m.group('project')
 
     def query_metadata(self) -> SiteMetadata:
-        res = next(self.query(meta='siteinfo', siprop=('magicwords', 'extensions', 'namespaces')))
+        res = next(self.query(meta='siteinfo', siprop=('magicwords', 'extensions', 'namespaces', 'namespacealiases')))
 
         # Only remember template-like magic words (uppercase, don't begin with a "_")
         words = [vvv for vv in
@@ -41,11 +48,19 @@ class WikiSite(Site):
         flagged_revisions = \
             bool([v for v in res.extensions if 'descriptionmsg' in v and v.descriptionmsg == 'flaggedrevs-desc'])
 
+        def ns_names(ns_id: int):
+            ns = res.namespaces[str(ns_id)]
+            names = {ns.name, ns.canonical}
+            names.update((v.alias for v in res.namespacealiases if v.id == ns_id))
+            return names
+
         return SiteMetadata(magic_words=magic_words,
                             magic_prefixes=magic_prefixes,
                             flagged_revisions=flagged_revisions,
                             template_ns=res.namespaces['10'].name,
                             module_ns=res.namespaces['828'].name,
+                            template_aliases=ns_names(10),
+                            module_aliases=ns_names(828),
                             )
 
     def query_pages_revid(self, titles: Iterable[str]) -> Iterable[Tuple[str, int]]:
@@ -65,7 +80,6 @@ class WikiSite(Site):
             if 'missing' in page:
                 yield page.title, None
                 continue
-            protection = [p.level for p in page.protection if p.type == 'edit']
             rev = page.revisions[0]
             # if self.get_metadata().flagged_revisions:
             #     TODO
@@ -75,15 +89,68 @@ class WikiSite(Site):
                 rev.revid,
                 content=rev.slots.main.content,
                 content_ts=rev.timestamp,
-                protection=list(set(protection)) or None,
+                protection=self._edit_protection(page),
+            )
+
+    def query_pages_hash(self, titles: Iterable[str]) -> Iterable[TitleHashPair]:
+        """
+        Same as query_pages_content(), but only with the SHA1 of the content, to avoid downloading the known content
+        """
+        for page in self.query_pages(
+                prop=['revisions', 'info'],
+                rvprop=['sha1', 'timestamp', 'ids'],
+                inprop=['protection'],
+                titles=titles):
+            if 'missing' in page:
+                yield page.title, None
+                continue
+            rev = page.revisions[0]
+            yield page.title, PageHash(
+                rev.revid,
+                sha1=rev.get('sha1'),
+                content_ts=rev.timestamp,
+                protection=self._edit_protection(page),
             )
 
-    def load_page_history(self, title: Title, history: List[RevComment]) -> List[RevComment]:
+    @staticmethod
+    def _edit_protection(page: AttrDict) -> Optional[List[str]]:
+        protection = [p.level for p in page.protection if p.type == 'edit']
+        return list(set(protection)) or None
+
+    def query_recent_changes(self, since: datetime, namespaces: Iterable[int],
+                             rc_filter: Callable[[AttrDict], bool] = None) -> Set[Title]:
+        """
+        Titles of the pages in the given namespaces that were edited, created, deleted, moved, or had their protection
+        changed since the given time. Moved pages are reported with both the old and the new title.
+        If given, the filter gets each change with its title and comment, and decides if it is reported.
+        """
+        titles = set()
+        for res in self.query(list='recentchanges',
+                              rcstart=to_timestamp(since),
+                              rcdir='newer',
+                              rcnamespace=list(namespaces),
+                              rctype=['edit', 'new', 'log'],
+                              rcprop=['title', 'loginfo', 'comment'] if rc_filter else ['title', 'loginfo'],
+                              rclimit='max'):
+            for rc in res.recentchanges:
+                if rc_filter and not rc_filter(rc):
+                    continue
+                titles.add(rc.title)
+                if 'logparams' in rc and 'target_title' in rc.logparams:
+                    titles.add(rc.logparams.target_title)
+        return titles
+
+    def load_page_history(self, title: Title, history: Sequence[RevComment],
+                          pool: FetchPool) -> Iterator[List[RevComment]]:
+        """
+        Revisions newer than the given history, from oldest to newest, in batches.
+        Revision metadata is listed first, and then the content of each batch is downloaded by revision ids,
+        several batches at once. Only a few batches are kept in memory at any time.
+        """
         params = dict(
             prop='revisions',
-            rvprop=['user', 'comment', 'timestamp', 'content', 'ids'],
-            rvlimit=25,
-            rvslots='main',
+            rvprop=['user', 'comment', 'timestamp', 'ids'],
+            rvlimit='max',
             rvdir='newer',
             titles=title,
         )
@@ -92,14 +159,33 @@ class WikiSite(Site):
         # there could (in theory) be more than one revision at the same timestamp,
         # ensure we don't duplicate
         rev_ids = set((v.revid for v in history))
-        result = []
-        for res in self.query(**params):
-            for r in res.pages[0].revisions:
-                if r.revid not in rev_ids:
-                    rev = RevComment(r.user, r.timestamp, r.comment.strip(),
-                                     r.slots.main.content, r.revid)
-                    result.append(rev)
-        return result
+
+        def list_revisions():
+            for res in self.query(**params):
+                for r in res.pages[0].get('revisions', []):
+                    if r.revid not in rev_ids:
+                        yield r
+
+        return pool.imap((self.domain, partial(self._load_revisions, batch))
+                         for batch in batches(list_revisions(), self._content_batch_size))
+
+    def _load_revisions(self, revisions: List[AttrDict]) -> List[RevComment]:
+        contents = {}
+        for res in self.query(prop='revisions', rvprop=['content', 'ids'], rvslots='main',
+                              revids=[r.revid for r in revisions]):
+            for page in res.get('pages', []):
+                for r in page.get('revisions', []):
+                    main = r.get('slots', {}).get('main', {})
+                    if 'texthidden' in r or 'texthidden' in main:
+                        # The content of a suppressed revision is not available to anyone
+                        contents[r.revid] = ''
+                    elif 'content' in main:
+                        contents[r.revid] = main.content
+        missing = [r.revid for r in revisions if r.revid not in contents]
+        if missing:
+            # Storing an empty content would make these revisions look like blanked pages forever
+            raise ValueError(f"{self.domain}: content of revisions {', '.join(map(str, missing))} was not returned")
+        return [RevComment(r.user, r.timestamp, r.comment.strip(), contents[r.revid], r.revid) for r in revisions]
 
     def __str__(self):
         return self.domain
@@ -110,4 +196,4 @@ class WikiSite(Site):
         if 'auth' in clone:
             del clone['auth']
         print(f'{self}: {dumps(clone, ensure_ascii=False)}'[:250])
-        return super().request(method, force_ssl, headers, **request_kw)
+        return super().request(method, force_ssl=force_ssl, headers=headers, **request_kw)
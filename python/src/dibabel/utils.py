@@ -19,6 +19,7 @@ T2 = TypeVar('T2')
 T3 = TypeVar('T3')
 
 primary_domain = 'www.mediawiki.org'
+wikidata_domain = 'www.wikidata.org'
 
 
 def list_to_dict_of_sets(items, key, value=None):
@@ -99,5 +100,5 @@ def calc_hash(content):
     return m.hexdigest()
 
 
-def parse_qid(row):
-    return row['id']['value'][len('http://www.wikidata.org/entity/'):]
+def parse_qid(url: str) -> QID:
+    return url[len('http://www.wikidata.org/entity/'):]
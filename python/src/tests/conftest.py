@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The tests import the modules the same way app.py and app.benchmark.py do
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+import fakeredis
+import pytest
+
+import dibabel.SessionState
+from StandInApi import StandInApi
+from dibabel.Controller import Controller
+from dibabel.SessionState import SessionState
+from dibabel.SitelinkSource import multi_site_class
+from dibabel.utils import primary_domain
+
+de_domain = 'de.wikipedia.org'
+
+
+@pytest.fixture
+def api(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(dibabel.SessionState, 'Redis', lambda host: fakeredis.FakeRedis(server=server))
+    api = StandInApi(namespaces={de_domain: {10: 'Vorlage', 828: 'Modul'}})
+    ts = datetime.utcnow() - timedelta(days=1)
+    api.edit(primary_domain, 'Template:Main', 'main text', ts=ts)
+    api.edit(de_domain, 'Vorlage:Haupt', 'main text', ts=ts)
+    api.set_item('Q1', [multi_site_class], {primary_domain: 'Template:Main', de_domain: 'Vorlage:Haupt'}, ts=ts)
+    return api
+
+
+def refresh(api: StandInApi, cache_file) -> dict:
+    with SessionState(cache_file, 'test', 'localhost') as state:
+        state.session.mount('https://', api)
+        Controller(state).refresh_state()
+        return Controller(state).get_data()
+
+
+def copy_status(data: dict, domain: str) -> str:
+    page, = data['pages']
+    copy, = (v for v in page['copies'] if v['domain'] == domain)
+    return copy['status']
+
+
+def test_refresh_finds_edited_localized_copy(api, tmp_path):
+    cache_file = tmp_path / 'cache.sqlite'
+    assert copy_status(refresh(api, cache_file), de_domain) == 'ok'
+    # The next refresh only checks the pages that are listed by the recent changes of each wiki
+    api.edit(de_domain, 'Vorlage:Haupt', 'changed text')
+    assert copy_status(refresh(api, cache_file), de_domain) == 'diverged'